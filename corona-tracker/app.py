@@ -3,15 +3,56 @@ import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 import plotly.graph_objects as go
-from dash.dependencies import Input, Output
+import plotly.io as pio
+import flask
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import pandas as pd
 import numpy as np
 import time
 import threading
+import functools
+import fcntl
+import hashlib
+import os
+import io
+import json
+import pickle
+import re
+import shutil
+import random
+import bisect
+import contextlib
+from abc import ABC, abstractmethod
+from urllib.parse import quote, unquote
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 import requests
 
-baseURLJH = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/"
+baseURLJH = os.environ.get('JHU_URL', "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/")
+JHU_FILES = {'CumConfirmed': 'time_series_covid19_confirmed_global.csv',
+             'CumDeaths': 'time_series_covid19_deaths_global.csv',
+             'CumRecovered': 'time_series_covid19_recovered_global.csv'}
+DATA_SOURCE = os.environ.get('DATA_SOURCE', 'ulklc') # 'ulklc', 'jhu', 'local' or 'synthetic'
+ULKLC_URL = os.environ.get('ULKLC_URL', 'https://raw.githubusercontent.com/ulklc/covid19-timeseries/master/countryReport/raw/rawReport.csv')
+LOCAL_DATA_DIR = os.environ.get('LOCAL_DATA_DIR') # snapshot directory the 'local' source reads, e.g. copied from another deployment
+SYNTHETIC_SIZE = tuple(int(n) for n in os.environ.get('SYNTHETIC_SIZE', '50,1,120').split(',')) # countries, states, days
+DOWNLOAD_TIMEOUT = float(os.environ.get('DOWNLOAD_TIMEOUT', 60)) # seconds, for connecting and for every read
+DOWNLOAD_RETRIES = 3 # retries of a failed download, after 2, 4 then 8 seconds
+DOWNLOAD_BACKOFF = 2 # seconds
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot'))
+MULTI_WORKER = os.environ.get('MULTI_WORKER') == '1' # one elected worker refreshes, the others follow its snapshot
+METRICS = os.environ.get('METRICS') == '1' # record histograms and counters, served on /metrics
+RELOAD_INTERVAL = int(os.environ.get('RELOAD_INTERVAL', 1 * 3600)) # reload interval in seconds
+REFRESH_BACKOFF = 30 # seconds before retrying a failed refresh, doubled on every failure up to RELOAD_INTERVAL
+STALE_AFTER = int(os.environ.get('STALE_AFTER', 3 * RELOAD_INTERVAL)) # /health fails when the data was not checked for this long
+DERIVED_CACHE_SIZE = 256 # number of derived (country, state) tables kept in memory per snapshot
+RESOLUTIONS = {'D': 1, 'W': 7, 'M': 30} # precomputed resolutions of the series and their days per point
+PERIOD_NAMES = {'D': 'Day', 'W': 'Week', 'M': 'Month'}
+MAX_POINTS = int(os.environ.get('MAX_POINTS', 120)) # a chart moves to a coarser resolution above this many points
+FORECAST_WINDOW = 14 # days the growth of a series is fitted on
+FORECAST_DAYS = 7 # days forecast after the last one
 
 #external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
@@ -27,6 +68,133 @@ tickFont = {'size': 15,
 
 
 cols_int =['CumConfirmed', 'CumDeaths', 'CumRecovered']
+cols_cat = ['Country/Region', 'Province/State']
+
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60) # in seconds
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Timer:
+    def __init__(self, registry, name, labels):
+        self.registry, self.name, self.labels = registry, name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Metrics:
+    # histograms, counters and gauges in the Prometheus text format, every call is a no-op
+    # when disabled so the instrumented code paths stay as fast as before
+    noTimer = contextlib.nullcontext()
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return self.noTimer
+        return Timer(self, name, labels)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def collector(self, collect):
+        # collect() is called on every scrape and returns (kind, name, labels, value) samples,
+        # for values that are cheaper to read when asked than to count as they change
+        self.collectors.append(collect)
+        return collect
+
+    def render(self):
+        def series(name, labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return name
+            return '%s{%s}' % (name, ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                                              for key, value in labels))
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(histogram.counts), histogram.sum) for key, histogram in self.histograms.items()}
+        # gauges all come from the collectors
+        gauges = {}
+        for collect in self.collectors:
+            for kind, name, labels, value in collect():
+                (counters if kind == 'counter' else gauges)[(name, tuple(sorted(labels.items())))] = value
+
+        lines, typed = [], set()
+        for kind, samples in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in sorted(samples.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    typed.add(name)
+                lines.append('%s %s' % (series(name, labels), value))
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            cumulative = np.cumsum(counts)
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), cumulative):
+                lines.append('%s %d' % (series(name + '_bucket', labels, [('le', bound)]), count))
+            lines.append('%s %s' % (series(name + '_sum', labels), total))
+            lines.append('%s %d' % (series(name + '_count', labels), cumulative[-1]))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS)
+
+def narrow_int(values):
+    # smallest integer type holding every value, the derived tables widen again before doing arithmetic
+    values = values.fillna(0)
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            narrowed = values.astype(dtype)
+            if not (narrowed == values).all():
+                raise ValueError('%s has non integer counts' % values.name)
+            return narrowed
+    raise OverflowError('%s does not fit in int64' % values.name)
+
+def compact_dtypes(data):
+    # categorical names, float32 coordinates and narrow counts, a few bytes per row instead of python strings
+    for col in cols_cat:
+        data[col] = data[col].astype('category')
+    for col in ('Lat', 'Long'):
+        data[col] = data[col].astype(np.float32)
+    for col in cols_int:
+        if col in data:
+            data[col] = narrow_int(data[col])
+    return data
+
 
 def loadDataJH(fileName, columnName):
 
@@ -36,14 +204,44 @@ def loadDataJH(fileName, columnName):
     data['Province/State'] = data['Province/State'].fillna('<all>')
     data.fillna(0, inplace=True)
 
-    data[columnName] = data[columnName].astype(np.int64)
-    
     data['date'] = data['date'].astype('datetime64[ns]')
-    return data
+    return compact_dtypes(data)
+
+
+def loadData_jhu(frames):
+    # frames are the wide JHU files by count column, they are aligned on (country, state) x date
+    # and laid out long in one go, no melt and no merges
+    wide = {}
+    for col, frame in frames.items():
+        frame['Province/State'] = frame['Province/State'].fillna('<all>')
+        frame = frame.set_index(['Country/Region', 'Province/State'])
+        wide[col] = frame[~frame.index.duplicated()]
+
+    keys = functools.reduce(lambda a, b: a.union(b), [frame.index for frame in wide.values()])
+    dateCols = functools.reduce(lambda a, b: a.union(b), [frame.columns.drop(['Lat', 'Long']) for frame in wide.values()])
+    dates = pd.to_datetime(dateCols, format='%m/%d/%y')
+    dateCols, dates = dateCols[np.argsort(dates.values)], dates.sort_values()
+    nDates = len(dates)
+
+    coords = pd.concat([frame[['Lat', 'Long']] for frame in wide.values()])
+    coords = coords[~coords.index.duplicated()].reindex(keys).fillna(0)
+    countries, states = [pd.Categorical(keys.get_level_values(level)) for level in (0, 1)]
+
+    data = pd.DataFrame({
+        'Province/State': pd.Categorical.from_codes(np.repeat(states.codes, nDates), states.categories),
+        'Country/Region': pd.Categorical.from_codes(np.repeat(countries.codes, nDates), countries.categories),
+        'Lat': np.repeat(coords['Lat'].to_numpy(np.float32), nDates),
+        'Long': np.repeat(coords['Long'].to_numpy(np.float32), nDates),
+        'date': np.tile(dates.values, len(keys)),
+    })
+    for col, frame in wide.items():
+        values = frame.reindex(index=keys, columns=dateCols).to_numpy(np.float64)
+        data[col] = np.nan_to_num(values).ravel()
+    return compact_dtypes(data)
 
 
-def loadData_ulklc():
-    data = pd.read_csv('https://raw.githubusercontent.com/ulklc/covid19-timeseries/master/countryReport/raw/rawReport.csv')
+def loadData_ulklc(source=ULKLC_URL):
+    data = pd.read_csv(source)
 
     data['day'] = data['day'].astype('datetime64[ns]')
 
@@ -60,342 +258,1223 @@ def loadData_ulklc():
     data.drop(['region', 'countryCode'], axis=1, inplace=True)
     data = data[['Province/State', 'Country/Region', 'Lat', 'Long', 'date', 'CumConfirmed', 'CumDeaths', 'CumRecovered']]
 
+    return compact_dtypes(data)
+
+
+
+def fix_data_errors(data):
+    # fix erros where cum value of today less than yesterday by carrying yesterday's value forward,
+    # done for all series at once, rows must be sorted so each (country, state) series is contiguous
+    values = data[cols_int].to_numpy()
+    country, state = [data[col].cat.codes.to_numpy() if isinstance(data[col].dtype, pd.CategoricalDtype)
+                      else data[col].to_numpy() for col in cols_cat]
+
+    newSeries = np.ones(len(data), dtype=bool)
+    newSeries[1:] = (country[1:] != country[:-1]) | (state[1:] != state[:-1])
+
+    errors = np.zeros(values.shape, dtype=bool)
+    errors[1:] = (values[1:] < values[:-1]) & ~newSeries[1:, None]
+
+    # index of the last valid row for every cell, an error never starts a series so this stays in its group
+    positions = np.where(errors, 0, np.arange(len(data))[:, None])
+    positions = np.maximum.accumulate(positions, axis=0)
+    fixed = np.take_along_axis(values, positions, axis=0)
+
+    for i, col in enumerate(cols_int):
+        data[col] = fixed[:, i].astype(data[col].dtype)
+    return data
+
+
+def sort_data(data):
+    # every (country, state) series becomes a contiguous block of rows ordered by date
+    return data.sort_values(['Country/Region', 'Province/State', 'date'], kind='mergesort')
+
+
+def clean_data(data):
+    data = sort_data(data).reset_index(drop=True)
+    with metrics.timer('refresh_stage_seconds', stage='fix_data_errors'):
+        return fix_data_errors(data)
+
+
+def build_index(data):
+    # callbacks slice the sorted frame with iloc instead of masking all of it, data must come sorted
+    stateSlices = {}
+    for key, ixs in data.groupby(['Country/Region', 'Province/State'], sort=False, observed=True).indices.items():
+        stateSlices[key] = slice(ixs[0], ixs[-1] + 1)
+
+    countrySlices, countryStates = {}, {}
+    for (country, state), rows in stateSlices.items():
+        if country in countrySlices:
+            countrySlices[country] = slice(countrySlices[country].start, rows.stop)
+        else:
+            countrySlices[country] = rows
+        countryStates.setdefault(country, {'<all>'}).add(state)
+    countryStates = {country: sorted(states) for country, states in countryStates.items()}
+
+    return data, countrySlices, stateSlices, countryStates
+
+
+def build_rollup(data):
+    # the '<all>' series of every country summed over its states, one groupby over the whole frame
+    # at refresh time instead of one per request, rollupSlices locates a country in it
+    rollup = data[['Country/Region', 'date']].assign(**{col: data[col].astype(np.int64) for col in cols_int}) \
+                 .groupby(['Country/Region', 'date'], observed=True, sort=True).sum().reset_index()
+    rollupSlices = {country: slice(ixs[0], ixs[-1] + 1) for country, ixs in
+                    rollup.groupby('Country/Region', sort=False, observed=True).indices.items()}
+    return rollup, rollupSlices
+
+
+def downsample(frame, slices, resolution):
+    # the last row of every week or month of every series, cumulative counts at the end of the period,
+    # frame must be sorted by series then date and slices must cover it
+    dates = frame['date'].to_numpy()
+    if resolution == 'W':
+        # weeks start on Monday, day 0 was a Thursday
+        periods = (dates.astype('datetime64[D]').astype(np.int64) + 3) // 7
+    else:
+        periods = dates.astype('datetime64[M]').astype(np.int64)
+
+    starts = np.array([rows.start for rows in slices.values()], dtype=np.int64)
+    stops = np.array([rows.stop for rows in slices.values()], dtype=np.int64)
+    newSeries = series_starts(slices, len(frame))
+    last = np.ones(len(frame), dtype=bool)
+    last[:-1] = newSeries[1:] | (periods[1:] != periods[:-1])
+    rows = np.flatnonzero(last)
+
+    sampled = frame.iloc[rows][['date'] + cols_int].astype({col: np.int64 for col in cols_int}).reset_index(drop=True)
+    starts, stops = rows.searchsorted(starts), rows.searchsorted(stops - 1) + 1
+    return sampled, {key: slice(start, stop) for key, start, stop in zip(slices, starts, stops)}
+
+
+def series_starts(slices, length):
+    # marks the first row of every series of a frame laid out by slices
+    starts = np.zeros(length, dtype=bool)
+    starts[[rows.start for rows in slices.values() if rows.start < length]] = True
+    return starts
+
+
+def derive_metrics(frame, starts):
+    # the metrics the page shows, for any number of series at once: frame is sorted by series
+    # then date and starts marks the first row of every series, differences never cross series
+    data = frame[['date'] + cols_int].astype({col: np.int64 for col in cols_int}).reset_index(drop=True)
+    data['CumActive'] = data['CumConfirmed'] - data['CumDeaths'] - data['CumRecovered']
+
+    cumCols = cols_int + ['CumActive']
+    cum = data[cumCols].to_numpy()
+    new = np.zeros_like(cum)
+    new[1:] = cum[1:] - cum[:-1]
+    new[starts] = 0
+    for i, col in enumerate(cumCols):
+        data[col.replace('Cum', 'New')] = new[:, i]
+
+    # new cases of the next day of the same series, none on the last day of a series
+    nextNew = np.full(len(data), np.nan)
+    nextNew[:-1] = new[1:, 0]
+    nextNew[np.append(starts[1:], True)[:len(data)]] = np.nan
+    data['DiffYesterday'] = ((pd.Series(nextNew) / data.CumConfirmed)*100).round(1)
+    data['MortalityRateInfection'] = ((data.CumDeaths / data.CumConfirmed)*100).round(1)
+    data['MortalityRateClosed'] = ((data.CumDeaths / (data.CumDeaths + data.CumRecovered))*100).round(1)
     return data
 
 
+# a resolution of the data: the country rollups with all their metrics and the (country, state)
+# series, whose metrics are derived when one is selected
+View = namedtuple('View', ['rollup', 'rollupSlices', 'states', 'stateSlices'])
+
+def build_views(data, stateSlices):
+    rollup, rollupSlices = build_rollup(data)
+    views = {'D': View(rollup, rollupSlices, data, stateSlices)}
+    for resolution in RESOLUTIONS:
+        if resolution != 'D':
+            views[resolution] = View(*downsample(rollup, rollupSlices, resolution),
+                                     *downsample(data, stateSlices, resolution))
+    for resolution, view in views.items():
+        views[resolution] = view._replace(rollup=derive_metrics(view.rollup, series_starts(view.rollupSlices, len(view.rollup))))
+    return views
+
+
+def build_ranking(view, growthDays=7):
+    # the latest day of every country, one row per country, for the rankings and comparisons
+    rollup = view.rollup
+    last = np.array([rows.stop - 1 for rows in view.rollupSlices.values()], dtype=np.int64)
+    first = np.array([rows.start for rows in view.rollupSlices.values()], dtype=np.int64)
+    ranking = rollup.iloc[last].drop(['date', 'DiffYesterday'], axis=1)
+    ranking.index = pd.Index([str(country) for country in view.rollupSlices], name='Country/Region')
+
+    # growth of the confirmed cases over the last week, when the series is that long
+    confirmed = rollup['CumConfirmed'].to_numpy()
+    earlier = np.where(last - growthDays >= first, confirmed[np.maximum(last - growthDays, 0)], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ranking['Growth'] = np.where(earlier > 0, (confirmed[last] - earlier) / earlier * 100, np.nan).round(1)
+    return ranking
+
+
+def fit_forecasts(frame, slices, window=FORECAST_WINDOW, days=FORECAST_DAYS):
+    # log-linear fit of the last window days of every series at once: the days of all series are
+    # laid out as one matrix and the least squares slope and intercept are masked row sums,
+    # returns the cumulative counts of the next days by series key, shaped (days, cols_int)
+    last = np.array([rows.stop - 1 for rows in slices.values()], dtype=np.int64)
+    first = np.array([rows.start for rows in slices.values()], dtype=np.int64)
+    rows = last[:, None] - np.arange(window - 1, -1, -1)
+    valid = rows >= first[:, None]
+    t = np.arange(window, dtype=np.float64)[None, :]
+    n = valid.sum(axis=1, keepdims=True)
+    tMean = (t * valid).sum(axis=1, keepdims=True) / n
+    tDev = np.where(valid, t - tMean, 0)
+    tVar = (tDev ** 2).sum(axis=1, keepdims=True)
+    future = window - 1 + np.arange(1, days + 1, dtype=np.float64)[None, :]
+
+    forecasts = np.empty((len(last), days, len(cols_int)), dtype=np.int64)
+    for i, col in enumerate(cols_int):
+        values = frame[col].to_numpy()
+        y = np.log1p(np.where(valid, values[np.maximum(rows, 0)], 0).astype(np.float64))
+        yMean = (y * valid).sum(axis=1, keepdims=True) / n
+        # cumulative counts never go down, a series with a single day stays flat
+        slope = np.maximum(np.divide((tDev * (y - yMean)).sum(axis=1, keepdims=True), tVar,
+                                     out=np.zeros_like(tVar), where=tVar > 0), 0)
+        predicted = np.expm1(yMean + slope * (future - tMean))
+        forecasts[:, :, i] = np.maximum(np.round(predicted), values[last][:, None])
+    return dict(zip(slices, forecasts))
+
+
+def build_forecasts(views):
+    # every (country, state) series and every country rollup, '<all>' is the rollup
+    daily = views['D']
+    forecasts = fit_forecasts(daily.states, daily.stateSlices)
+    forecasts.update({(country, '<all>'): forecast for country, forecast in
+                      fit_forecasts(daily.rollup, daily.rollupSlices).items()})
+    return forecasts
+
+
+def build_options(countries, countryStates):
+    # the dropdown options as the callbacks return them, built once per version instead of per request
+    countryOptions = [{'label':c, 'value':c} for c in countries]
+    stateOptions = {country: [{'label':s, 'value':s} for s in states] for country, states in countryStates.items()}
+    return countryOptions, stateOptions
+
+
+class SnapshotCache:
+    # what callbacks derive from one snapshot, it lives and goes away with that snapshot so a
+    # table can never be derived from one version and served as another
+
+    def __init__(self, maxsize=DERIVED_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-allData = loadData_ulklc()
-countries = allData['Country/Region'].unique()
-countries.sort()
+    def get(self, key, build):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        # built outside the lock, two threads may build the same entry and the last one is kept
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+
+# everything the callbacks read, published as one object so a reload is a single reference swap,
+# a callback takes the current dataset once and reads everything from it
+Dataset = namedtuple('Dataset', ['data', 'countrySlices', 'stateSlices', 'countryStates', 'countries',
+                                 'countryOptions', 'stateOptions', 'views', 'ranking', 'forecasts',
+                                 'cache', 'version', 'validators', 'highWater', 'layout'])
+
+def make_dataset(data, version, validators):
+    data, countrySlices, stateSlices, countryStates = build_index(data)
+    countries = sorted(countrySlices)
+    views = build_views(data, stateSlices)
+    dataset = Dataset(data, countrySlices, stateSlices, countryStates, np.array(countries),
+                   *build_options(countries, countryStates), views, build_ranking(views['D']),
+                   build_forecasts(views), SnapshotCache(), version, validators, data['date'].max(), None)
+    # the page of this version, built once rather than on every page load
+    return dataset._replace(layout=build_layout(dataset))
+
+
+def fetch_if_changed(url, validators):
+    # conditional download, returns None as content when the source did not change since validators
+    with metrics.timer('refresh_download_seconds', file=os.path.basename(url)):
+        return _fetch_if_changed(url, validators)
+
+def _fetch_if_changed(url, validators):
+    if not url.startswith(('http://', 'https://')):
+        modified = str(os.stat(url).st_mtime_ns)
+        if modified == validators.get('last-modified'):
+            return None, validators
+        with open(url, 'rb') as f:
+            return f.read(), {'last-modified': modified}
+
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last-modified'):
+        headers['If-Modified-Since'] = validators['last-modified']
+    response = get_with_retries(url, headers)
+    if response.status_code == 304:
+        return None, validators
+    response.raise_for_status()
+    return response.content, {'etag': response.headers.get('ETag'),
+                              'last-modified': response.headers.get('Last-Modified')}
+
+
+def get_with_retries(url, headers):
+    # connection errors, timeouts and server errors are retried with exponential backoff
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            response = requests.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+            if response.status_code < 500 or attempt == DOWNLOAD_RETRIES:
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+        metrics.inc('refresh_download_retries_total', file=os.path.basename(url))
+        time.sleep(DOWNLOAD_BACKOFF * 2 ** attempt)
+
+
+def synthetic_data(countries=50, states=1, days=120, seed=0):
+    # cumulative counts with about 1% reporting errors, the first country is the default one of the layout
+    rng = np.random.default_rng(seed)
+    countryNames = ['Egypt'] + ['Country %03d' % i for i in range(1, countries)]
+    stateNames = ['<all>'] if states == 1 else ['State %02d' % i for i in range(states)]
+    series = len(countryNames) * len(stateNames)
+
+    data = pd.DataFrame({
+        'Province/State': np.tile(np.repeat(stateNames, days), len(countryNames)),
+        'Country/Region': np.repeat(countryNames, len(stateNames) * days),
+        'Lat': np.repeat(rng.uniform(-60, 60, series).round(4), days),
+        'Long': np.repeat(rng.uniform(-180, 180, series).round(4), days),
+        'date': np.tile(pd.date_range('2020-01-22', periods=days).values, series),
+    })
+    for col, rate in (('CumConfirmed', 50), ('CumDeaths', 2), ('CumRecovered', 20)):
+        values = rng.poisson(rate, (series, days)).cumsum(axis=1)
+        errors = rng.random((series, days)) < 0.01
+        values[errors] = np.maximum(values[errors] - 10 * rate, 0)
+        data[col] = values.ravel()
+    return compact_dtypes(data)
+
+
+class DataSource(ABC):
+    # fetch(validators) returns the long frame and the validators to pass next time,
+    # the frame is None when the source did not change since validators
+
+    @abstractmethod
+    def fetch(self, validators):
+        pass
+
+
+class UlklcSource(DataSource):
+    # the ulklc rawReport.csv, from a URL or a local path
+
+    def __init__(self, url=ULKLC_URL):
+        self.url = url
+
+    def fetch(self, validators):
+        content, validators = fetch_if_changed(self.url, validators)
+        if content is None:
+            return None, validators
+        with metrics.timer('refresh_parse_seconds', source='ulklc'):
+            return loadData_ulklc(io.BytesIO(content)), validators
+
+
+class JhuSource(DataSource):
+    # the three JHU time series files under a base URL or a local directory,
+    # downloaded and parsed concurrently
+
+    def __init__(self, baseURL=baseURLJH):
+        self.baseURL = baseURL
+
+    def fetch(self, validators):
+        def fetch(fileName, fileValidators):
+            return fetch_if_changed(self.baseURL + fileName, fileValidators)
+
+        fileNames = list(JHU_FILES.values())
+        with ThreadPoolExecutor(len(fileNames)) as pool:
+            results = list(pool.map(fetch, fileNames, [validators.get(fileName, {}) for fileName in fileNames]))
+            if all(content is None for content, _ in results):
+                return None, validators
+            # a file that did not change has to be read again, only the frame is kept between reloads
+            results = list(pool.map(lambda fileName, result: result if result[0] is not None else fetch(fileName, {}),
+                                    fileNames, results))
+            with metrics.timer('refresh_parse_seconds', source='jhu'):
+                frames = list(pool.map(lambda result: pd.read_csv(io.BytesIO(result[0])), results))
+                data = loadData_jhu(dict(zip(JHU_FILES, frames)))
+
+        validators = {fileName: fileValidators for fileName, (_, fileValidators) in zip(fileNames, results)}
+        return data, validators
+
+
+class LocalSource(DataSource):
+    # a snapshot directory written by save_snapshot, no network access at all
+
+    def __init__(self, directory=LOCAL_DATA_DIR):
+        self.directory = directory
+
+    def fetch(self, validators):
+        stamp = str(snapshot_stamp(self.directory))
+        if stamp == validators.get('snapshot'):
+            return None, validators
+        # only the frame, the dataset is built from it like from any other source
+        snapshot = load_snapshot_frame(self.directory)
+        if snapshot is None:
+            raise OSError('no snapshot in %s' % self.directory)
+        return snapshot[0], {'snapshot': stamp}
+
+
+class SyntheticSource(DataSource):
+    # generated data of a given size, for running and benchmarking without network access
+
+    def __init__(self, countries=50, states=1, days=120, seed=0):
+        self.size = (countries, states, days, seed)
+
+    def fetch(self, validators):
+        key = ','.join(map(str, self.size))
+        if key == validators.get('synthetic'):
+            return None, validators
+        with metrics.timer('refresh_parse_seconds', source='synthetic'):
+            return synthetic_data(*self.size), {'synthetic': key}
+
+
+def make_source(name=DATA_SOURCE):
+    if name == 'ulklc':
+        return UlklcSource(ULKLC_URL)
+    if name == 'jhu':
+        return JhuSource(baseURLJH)
+    if name == 'local':
+        # checked here, a missing directory would otherwise fail every refresh attempt forever
+        if not LOCAL_DATA_DIR:
+            raise ValueError("DATA_SOURCE 'local' needs LOCAL_DATA_DIR")
+        return LocalSource(LOCAL_DATA_DIR)
+    if name == 'synthetic':
+        return SyntheticSource(*SYNTHETIC_SIZE)
+    raise ValueError('unknown DATA_SOURCE %r' % name)
+
+
+def data_digest(data):
+    # of the rows as the source gave them, before any fix, so the same content always has the same digest
+    return hashlib.sha1(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes()).hexdigest()
+
+
+def update_dataset(current):
+    # returns current itself when nothing changed, a dataset with a new version otherwise
+    with metrics.timer('refresh_seconds'):
+        result, newDataset = _update_dataset(current)
+    metrics.inc('refresh_total', result=result)
+    return newDataset
+
+def _update_dataset(current):
+    validators = current.validators if current is not None else {}
+    data, validators = dataSource.fetch(validators)
+    if data is None:
+        return 'unchanged', current
+
+    # a changed source is always rebuilt, fixing only new days would depend on the fixed history
+    # instead of the raw one and give other counts than a rebuild
+    validators = dict(validators, digest=data_digest(data))
+    if current is not None and validators['digest'] == current.validators.get('digest'):
+        return 'unchanged', current._replace(validators=validators)
+    return 'rebuilt', make_dataset(clean_data(data), current.version + 1 if current is not None else 1, validators)
+
+
+def save_snapshot(dataset, directory=SNAPSHOT_DIR):
+    # typed columnar copy of the dataset, one .npy file per column so workers can memory map it
+    # and share the pages, CURRENT names the latest complete version
+    path = os.path.join(directory, 'v%d' % dataset.version)
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    os.makedirs(tmpPath, exist_ok=True)
+
+    meta = {'version': dataset.version, 'validators': dataset.validators, 'columns': [], 'categories': {}}
+    for i, col in enumerate(dataset.data.columns):
+        values = dataset.data[col]
+        if col in cols_cat:
+            values = values.astype('category')
+            meta['categories'][col] = values.cat.categories.tolist()
+            values = values.cat.codes
+        elif col == 'date':
+            values = values.astype('datetime64[ns]')
+        np.save(os.path.join(tmpPath, '%d.npy' % i), values.to_numpy())
+        meta['columns'].append(col)
+    with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(tmpPath)
+    else:
+        os.replace(tmpPath, path)
+    with open(os.path.join(directory, 'CURRENT.tmp'), 'w') as f:
+        f.write('v%d' % dataset.version)
+    os.replace(os.path.join(directory, 'CURRENT.tmp'), os.path.join(directory, 'CURRENT'))
+
+    # workers still mapping an older version keep their pages until they move on
+    for name in os.listdir(directory):
+        if name.startswith('v') and name != 'v%d' % dataset.version and not name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def load_snapshot(directory=SNAPSHOT_DIR):
+    # returns None when there is no usable snapshot
+    snapshot = load_snapshot_frame(directory)
+    if snapshot is None:
+        return None
+    data, meta = snapshot
+    return make_dataset(data, meta['version'], meta['validators'])
+
+def load_snapshot_frame(directory=SNAPSHOT_DIR):
+    # the memory mapped frame and the meta of the snapshot, None when there is no usable one
+    try:
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            path = os.path.join(directory, f.read().strip())
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        columns = {}
+        for i, col in enumerate(meta['columns']):
+            values = np.load(os.path.join(path, '%d.npy' % i), mmap_mode='r')
+            if col in meta['categories']:
+                values = pd.Categorical.from_codes(values, meta['categories'][col])
+            columns[col] = values
+    except (OSError, ValueError, KeyError):
+        return None
+    return pd.DataFrame(columns, copy=False), meta
+
+
+refreshLock = None
+
+def is_refresher():
+    # in multi worker mode the worker holding the lock file refreshes, the lock goes away with
+    # its process so another worker takes over on its next try
+    global refreshLock
+    if not MULTI_WORKER or refreshLock is not None:
+        return True
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    # appended to, not truncated, so trying the lock leaves the file as it is
+    lockFile = open(os.path.join(SNAPSHOT_DIR, 'refresh.lock'), 'a')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lockFile.close()
+        return False
+    refreshLock = lockFile
+    return True
+
+def snapshot_stamp(directory=SNAPSHOT_DIR):
+    try:
+        return os.stat(os.path.join(directory, 'CURRENT')).st_mtime_ns
+    except OSError:
+        return None
+
+
+dataSource = make_source()
+
+def backoff(failures):
+    # exponential with jitter so workers and retries spread out instead of hitting the source together
+    return min(REFRESH_BACKOFF * 2 ** (failures - 1), RELOAD_INTERVAL) * random.uniform(0.5, 1)
+
+refreshState = {'lastSuccess': None, 'failures': 0, 'lastError': None, 'started': time.time()}
 
 confirmed_eg, recovers_eg, deaths_eg = 0, 0, 0
 
-RELOAD_INTERVAL = 1 * 3600 # reload interval in seconds
+RESULT_STORE_SIZE = 256 # number of callback results kept in memory
+# e.g. /dev/shm/corona-tracker to share results between workers, next to the snapshot by default in multi worker mode
+RESULT_STORE_DIR = os.environ.get('RESULT_STORE_DIR') or (os.path.join(SNAPSHOT_DIR, 'results') if MULTI_WORKER else None)
+FIGURE_CACHE_SIZE = 512 # number of built figures kept in memory
+RAW_FIGURES = os.environ.get('RAW_FIGURES') == '1' # build figure dicts directly, skipping plotly's validation
+LATENCY_SAMPLES = 1000 # latest callback durations kept for the percentiles in /stats
+DATE_WINDOWS = {14: 'Last 14 days', 30: 'Last 30 days', 0: 'Full history'} # days shown, 0 for all of them
+DEFAULT_WINDOW = int(os.environ.get('DEFAULT_WINDOW', 14))
+RANKING_METRICS = {'NewConfirmed': 'New Cases', 'NewDeaths': 'New Deaths', 'CumActive': 'Active Cases',
+                   'MortalityRateInfection': 'Mortality Rate', 'Growth': 'Weekly Growth'}
+RANKING_SIZES = [10, 20, 50]
+COMPARE_METRICS = {'CumConfirmed': 'Confirmed', 'CumDeaths': 'Deaths', 'CumActive': 'Active',
+                   'NewConfirmed': 'New Cases', 'NewDeaths': 'New Deaths', 'MortalityRateInfection': 'Mortality Rate'}
+COMPARE_MAX = 10 # countries drawn at most in the comparison chart
+VERSION_POLL_INTERVAL = int(os.environ.get('VERSION_POLL_INTERVAL', 5 * 60)) # how often a page checks for new data, in seconds
+
+
+class MemoryResultStore:
+    # callback results keyed by a short token, the 'intermediate' div only carries the token
+    # and consumers get the very same frame back instead of a json copy
+
+    def __init__(self, maxsize=RESULT_STORE_SIZE):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, key, data):
+        with self.lock:
+            self.results[key] = data
+            self.results.move_to_end(key)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            data = self.results.get(key)
+            if data is not None:
+                self.results.move_to_end(key)
+            return data
+
+    def discard_before(self, version):
+        with self.lock:
+            for key in [key for key in self.results if result_version(key) < version]:
+                del self.results[key]
+
+
+class FileResultStore(MemoryResultStore):
+    # memory store backed by pickles in a local (or tmpfs) directory, so a token produced
+    # by one worker can be resolved by another one
+
+    def __init__(self, directory, maxsize=RESULT_STORE_SIZE):
+        super().__init__(maxsize)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        # named by a digest of the key, the key itself never becomes a path
+        return os.path.join(self.directory, '%d-%s.pkl' % (result_version(key), hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def put(self, key, data):
+        super().put(key, data)
+        path = self.path(key)
+        if not os.path.exists(path):
+            tmpPath = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmpPath, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpPath, path)
+
+    def get(self, key):
+        data = super().get(key)
+        if data is None:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    data = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                return None
+            super().put(key, data)
+        return data
+
+    def discard_before(self, version):
+        super().discard_before(version)
+        for fileName in os.listdir(self.directory):
+            if fileName.endswith('.pkl') and int(fileName.split('-', 1)[0]) < version:
+                try:
+                    os.remove(os.path.join(self.directory, fileName))
+                except OSError:
+                    pass
+
+
+def result_key(version, *args):
+    # readable and reversible, so a token whose result was evicted or discarded can be rebuilt
+    # from the current data, quoted so it is also a file name
+    return '|'.join([str(version)] + [quote(json.dumps(arg), safe='') for arg in args])
+
+def result_version(key):
+    return int(key.split('|', 1)[0])
+
+def parse_result_key(key):
+    # the token comes back from the browser, anything but the arguments of nonreactive_data is refused
+    if not isinstance(key, str) or not re.fullmatch(r'\d+(\|[A-Za-z0-9%._~-]+){3}', key) or '..' in key:
+        return None
+    try:
+        country, state, window = [json.loads(unquote(arg)) for arg in key.split('|')[1:]]
+    except ValueError:
+        return None
+    if not (isinstance(country, str) and isinstance(state, (str, type(None))) and
+            (window is None or type(window) is int)):
+        return None
+    return country, state, window
+
+def load_result(key):
+    args = parse_result_key(key)
+    if args is None:
+        raise PreventUpdate
+    data = resultStore.get(key)
+    if data is None:
+        country, state, window = args
+        current = sync_dataset()
+        data = derived_data(current, country, state, window)
+        if result_version(key) == current.version:
+            resultStore.put(key, data)
+    return data
+
+
+class FigureCache(MemoryResultStore):
+    # built figures as plain dicts, keyed by the result key plus the chart and its metrics
+
+    def __init__(self, maxsize=FIGURE_CACHE_SIZE):
+        super().__init__(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def figure(self, key, build):
+        figure = self.get(key)
+        # read by /stats and /metrics from other request threads
+        with self.lock:
+            if figure is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if figure is not None:
+            return figure
+        figure = build()
+        self.put(key, figure)
+        return figure
+
+
+latencies = {}
+
+def record_latency(name, start):
+    elapsed = time.perf_counter() - start
+    latencies.setdefault(name, deque(maxlen=LATENCY_SAMPLES)).append(elapsed)
+    metrics.observe('callback_seconds', elapsed, callback=name)
+
+
+resultStore = FileResultStore(RESULT_STORE_DIR) if RESULT_STORE_DIR else MemoryResultStore()
+figureCache = FigureCache()
 
 
 
 def refresh_data_every():
+    # a failed refresh keeps the current data and is retried with backoff, the thread never dies
     while True:
-        refresh_data()
-        time.sleep(RELOAD_INTERVAL)
+        delay = RELOAD_INTERVAL * random.uniform(0.9, 1.1)
+        if is_refresher():
+            try:
+                refresh_data()
+                refresh_succeeded()
+            except Exception as e:
+                refreshState['failures'] += 1
+                refreshState['lastError'] = repr(e)
+                metrics.inc('refresh_failures_total')
+                delay = backoff(refreshState['failures'])
+                print('REFRESH FAILED: %r, retrying in %.0f s' % (e, delay))
+        time.sleep(delay)
+
+def refresh_succeeded():
+    refreshState.update(lastSuccess=time.time(), failures=0, lastError=None)
+    if MULTI_WORKER:
+        # the other workers read their staleness from this stamp
+        with open(os.path.join(SNAPSHOT_DIR, 'refreshed'), 'a'):
+            pass
+        os.utime(os.path.join(SNAPSHOT_DIR, 'refreshed'))
+
+def last_refresh():
+    # when the data was last checked against its source, by this worker or by the elected refresher
+    if not MULTI_WORKER or refreshLock is not None:
+        return refreshState['lastSuccess']
+    try:
+        return os.stat(os.path.join(SNAPSHOT_DIR, 'refreshed')).st_mtime
+    except OSError:
+        return None
+
+def staleness():
+    # since the last successful check, or since the start while there was none
+    lastSuccess = last_refresh()
+    return time.time() - (lastSuccess if lastSuccess is not None else refreshState['started'])
 
 def refresh_data():
-    global allData, countries, confirmed_eg, recovers_eg, deaths_eg
-    ### some expensive computation function to update dataframe
-    # allData = loadDataJH("time_series_covid19_confirmed_global.csv", "CumConfirmed") \
-    #         .merge(loadDataJH("time_series_covid19_deaths_global.csv", "CumDeaths")) \
-    #         .merge(loadDataJH("time_series_19-covid-Recovered.csv", "CumRecovered"))
-    allData = loadData_ulklc()
-    countries = allData['Country/Region'].unique()
-    countries.sort()
+    global dataset, snapshotStamp, confirmed_eg, recovers_eg, deaths_eg
+    if MULTI_WORKER and snapshot_stamp() != snapshotStamp:
+        # continue from the latest snapshot, a previous refresher may have published it
+        syncLock.acquire()
+        load_published()
+    current = dataset
+    newDataset = update_dataset(current)
+    if newDataset.version == current.version:
+        dataset = newDataset
+        print('DATA UNCHANGED')
+        return
+
+    with syncLock:
+        save_snapshot(newDataset)
+        # continue from the memory mapped copy of the frame so its pages are shared with the other
+        # workers, the structures derived from it stay as they are
+        snapshot = load_snapshot_frame()
+        if snapshot is not None and snapshot[1]['version'] == newDataset.version:
+            data = snapshot[0]
+            views = dict(newDataset.views, D=newDataset.views['D']._replace(states=data))
+            newDataset = newDataset._replace(data=data, views=views)
+        publish(newDataset)
+        # our own snapshot, not one to reload
+        snapshotStamp = snapshot_stamp()
 
     print('DATA UPDATED!!')
 
-thread = threading.Thread(target=refresh_data_every, daemon=True)
-thread.start()
+def publish(newDataset):
+    # the swap is the whole publication, the derived caches of the old dataset go away with it
+    # and the shared stores are keyed by version so they only need trimming
+    global dataset
+    dataset = newDataset
+    resultStore.discard_before(newDataset.version)
+    figureCache.discard_before(newDataset.version)
+
+syncLock = threading.Lock()
+
+def sync_dataset():
+    # one stat per request, a worker only reloads when the refresher published a new snapshot,
+    # in a thread of its own while requests keep being served from the current dataset
+    if not MULTI_WORKER:
+        return dataset
+    if snapshot_stamp() != snapshotStamp and syncLock.acquire(blocking=False):
+        threading.Thread(target=load_published, daemon=True).start()
+    return dataset
+
+def load_published():
+    global snapshotStamp
+    try:
+        stamp = snapshot_stamp()
+        newDataset = load_snapshot()
+        snapshotStamp = stamp
+        if newDataset is not None and newDataset.version > dataset.version:
+            publish(newDataset)
+    finally:
+        syncLock.release()
 
 app = dash.Dash(__name__)
 app.title = 'EG - Coronavirus COVID-19 Tracker'
 
-app.layout = html.Div(className='body',
-                style={
-                    'family':"sans-serif" ,
-                    'backgroundColor': colors['background'],
-                    'position':'absolute',
-                    'width':'100%',
-                    'height':'100%',
-                    'top':'0px',
-                    'left':'0px',
-                    'z-index':'1000'
-                    },
-                children=[
-                html.H1('Egypt Coronavirus (COVID-19) Tracker', 
-                        style={
-                            'textAlign': 'center',
-                            'margin-top': '3rem',
-                            'color': colors['text']
-                        }),
-                html.Div(className="row", 
-                        style={'margin-left': '2rem'},
-                        children=[
-                    html.Div(className="three columns", children=[
-                        html.H5('Country', 
-                                    style={
-                                            'textAlign': 'left',
-                                            'color': colors['text']
-                                        }
-                                ),
-                        dcc.Dropdown(
-                            id='country',
-                            options=[{'label':c, 'value':c} for c in countries],
-                            value='Egypt',
-                            disabled=False
-                        )
-                    ]),
-                    html.Div(className="three columns", children=[
-                        html.H5('Governorate/State', 
-                                    style={
-                                            'textAlign': 'left',
-                                            'color': colors['text']
-                                            }),
-                        dcc.Dropdown(
-                            id='state'
-                        )
-                    ]),
-                    html.Div(className="three columns", children=[
-                        html.H5('Selected Metrics', 
-                                    style={
-                                            'textAlign': 'left',
-                                            'color': colors['text']
-                                            }),
-                        dcc.Checklist(
-                            id='metrics',
-                            options=[{'label':m, 'value':m} for m in ['Confirmed', 'Deaths', 'Recovered', 'Active']],
-                            value=['Confirmed', 'Deaths', 'Active'], 
-                                    style={
-                                            'textAlign': 'left',
-                                            'color': colors['text']
+def build_layout(dataset):
+    # one component tree per data version, the options come precomputed with the dataset
+    return html.Div(className='body',
+                    style={
+                        'family':"sans-serif" ,
+                        'backgroundColor': colors['background'],
+                        'position':'absolute',
+                        'width':'100%',
+                        'height':'100%',
+                        'top':'0px',
+                        'left':'0px',
+                        'z-index':'1000'
+                        },
+                    children=[
+                    html.H1('Egypt Coronavirus (COVID-19) Tracker', 
+                            style={
+                                'textAlign': 'center',
+                                'margin-top': '3rem',
+                                'color': colors['text']
+                            }),
+                    html.Div(className="row", 
+                            style={'margin-left': '2rem'},
+                            children=[
+                        html.Div(className="three columns", children=[
+                            html.H5('Country', 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
                                             }
+                                    ),
+                            dcc.Dropdown(
+                                id='country',
+                                options=dataset.countryOptions,
+                                value='Egypt',
+                                disabled=False
                             )
-                        ])
-                    ]),
-                html.Div(className="row", children=[
-                    html.Div(className="three columns", children=[
-                        html.Div(
-                            [html.H2(id="confirmed_text"), html.H4("Confirmed", 
-                                                                    style={
-                                                                            'textAlign': 'left',
-                                                                            'color': colors['background']
-                                                                        }
-                                                                    )
-                                                                ],
-                                     id="confirmed",
-                                     className="mini_container",
-                                    )
-                                ]
-                            ),
+                        ]),
                         html.Div(className="three columns", children=[
-                            html.Div(
-                                [html.H2(id='deaths_text'), 
-                                 html.H4("Deaths", 
-                                            style={
-                                                    'textAlign': 'left',
-                                                    'color': colors['background']
+                            html.H5('Governorate/State', 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
+                                                }),
+                            dcc.Dropdown(
+                                id='state'
+                            )
+                        ]),
+                        html.Div(className="three columns", children=[
+                            html.H5('Selected Metrics', 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
+                                                }),
+                            dcc.Checklist(
+                                id='metrics',
+                                options=[{'label':m, 'value':m} for m in ['Confirmed', 'Deaths', 'Recovered', 'Active']],
+                                value=['Confirmed', 'Deaths', 'Active'], 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
                                                 }
-                                            )
-                                        ],
-                                    id="deaths",
-                                    className="mini_container",
-                                    )
-                                ]
-                            ),
+                                ),
+                            dcc.Checklist(
+                                id='forecast',
+                                options=[{'label':'Show %d day forecast' % FORECAST_DAYS, 'value':'forecast'}],
+                                value=[], 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
+                                                }
+                                )
+                            ]),
                         html.Div(className="three columns", children=[
-                            html.Div(
-                                [html.H2(id="recovered_text"), 
-                                 html.H4("Recovered", 
-                                            style={
-                                                    'textAlign': 'left',
-                                                    'color': colors['background']
+                            html.H5('Date Range', 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
+                                                }),
+                            dcc.RadioItems(
+                                id='window',
+                                options=[{'label':label, 'value':days} for days, label in DATE_WINDOWS.items()],
+                                value=DEFAULT_WINDOW, 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
                                                 }
-                                            )
-                                        ],
-                                    id="recovered",
-                                    className="mini_container",
-                                    )
-                                ]
-                            ),
+                                )
+                            ])
+                        ]),
+                    html.Div(className="row", children=[
                         html.Div(className="three columns", children=[
+                            html.Div(
+                                [html.H2(id="confirmed_text"), html.H4("Confirmed", 
+                                                                        style={
+                                                                                'textAlign': 'left',
+                                                                                'color': colors['background']
+                                                                            }
+                                                                        )
+                                                                    ],
+                                         id="confirmed",
+                                         className="mini_container",
+                                        )
+                                    ]
+                                ),
+                            html.Div(className="three columns", children=[
                                 html.Div(
-                                    [html.H2(id="active_text"), 
-                                    html.H4("Active", 
+                                    [html.H2(id='deaths_text'), 
+                                     html.H4("Deaths", 
                                                 style={
                                                         'textAlign': 'left',
                                                         'color': colors['background']
                                                     }
                                                 )
                                             ],
-                                    id="active",
-                                    className="mini_container",
+                                        id="deaths",
+                                        className="mini_container",
+                                        )
+                                    ]
                                 ),
-                            ],
-                        )
-                    ]),
+                            html.Div(className="three columns", children=[
+                                html.Div(
+                                    [html.H2(id="recovered_text"), 
+                                     html.H4("Recovered", 
+                                                style={
+                                                        'textAlign': 'left',
+                                                        'color': colors['background']
+                                                    }
+                                                )
+                                            ],
+                                        id="recovered",
+                                        className="mini_container",
+                                        )
+                                    ]
+                                ),
+                            html.Div(className="three columns", children=[
+                                    html.Div(
+                                        [html.H2(id="active_text"), 
+                                        html.H4("Active", 
+                                                    style={
+                                                            'textAlign': 'left',
+                                                            'color': colors['background']
+                                                        }
+                                                    )
+                                                ],
+                                        id="active",
+                                        className="mini_container",
+                                    ),
+                                ],
+                            )
+                        ]),
 
-                html.Div(className="row", children=[
+                    html.Div(className="row", children=[
 
-                    html.Div(className="three columns", children=[
-                        html.Div(
-                            [html.H2(id='expected_cases_by_tomorrow_text', children='NA'), 
-                             html.H5("Expected Cases by Tomorrow", 
-                                            style={
-                                                    'textAlign': 'left',
-                                                    'color': colors['background']
-                                                }
-                                            )
-                                        ],
-                                    id="expected_cases_by_tomorrow",
-                                    className="mini_container",
-                                    )
-                                ]
-                            ),
+                        html.Div(className="three columns", children=[
+                            html.Div(
+                                [html.H2(id='expected_cases_by_tomorrow_text', children='NA'), 
+                                 html.H5("Expected Cases by Tomorrow", 
+                                                style={
+                                                        'textAlign': 'left',
+                                                        'color': colors['background']
+                                                    }
+                                                )
+                                            ],
+                                        id="expected_cases_by_tomorrow",
+                                        className="mini_container",
+                                        )
+                                    ]
+                                ),
 
-                    html.Div(className="three columns", children=[
-                        html.Div(
-                            [html.H2(id="cases_increase_text"), 
-                             html.H5("Cases Increase From Yesterday", 
-                                                                    style={
-                                                                            'textAlign': 'left',
-                                                                            'color': colors['background']
-                                                                        }
-                                                                    )
-                                                                ],
-                                     id="cases_increase",
-                                     className="mini_container",
-                                    )
-                                ]
-                            ),
-                    html.Div(className="three columns", children=[
-                        html.Div(
-                            [html.H2(id="mortality_rate_infection_text"), 
-                             html.H5("Mortality Rate / Infection Case", 
-                                                                    style={
-                                                                            'textAlign': 'left',
-                                                                            'color': colors['background']
-                                                                        }
-                                                                    )
-                                                                ],
-                                     id="mortality_rate_infections",
-                                     className="mini_container",
-                                    )
-                                ]
-                            ),
                         html.Div(className="three columns", children=[
                             html.Div(
-                                [html.H2(id='mortality_rate_closed_text'), 
-                                 html.H5("Mortality Rate / Closed Case", 
-                                            style={
-                                                    'textAlign': 'left',
-                                                    'color': colors['background']
-                                                }
-                                            )
-                                        ],
-                                    id="mortality_rate_closed",
-                                    className="mini_container",
-                                    )
-                                ]
-                            )
-                        ],
-                    )
-                    ,
+                                [html.H2(id="cases_increase_text"), 
+                                 html.H5("Cases Increase From Yesterday", 
+                                                                        style={
+                                                                                'textAlign': 'left',
+                                                                                'color': colors['background']
+                                                                            }
+                                                                        )
+                                                                    ],
+                                         id="cases_increase",
+                                         className="mini_container",
+                                        )
+                                    ]
+                                ),
+                        html.Div(className="three columns", children=[
+                            html.Div(
+                                [html.H2(id="mortality_rate_infection_text"), 
+                                 html.H5("Mortality Rate / Infection Case", 
+                                                                        style={
+                                                                                'textAlign': 'left',
+                                                                                'color': colors['background']
+                                                                            }
+                                                                        )
+                                                                    ],
+                                         id="mortality_rate_infections",
+                                         className="mini_container",
+                                        )
+                                    ]
+                                ),
+                            html.Div(className="three columns", children=[
+                                html.Div(
+                                    [html.H2(id='mortality_rate_closed_text'), 
+                                     html.H5("Mortality Rate / Closed Case", 
+                                                style={
+                                                        'textAlign': 'left',
+                                                        'color': colors['background']
+                                                    }
+                                                )
+                                            ],
+                                        id="mortality_rate_closed",
+                                        className="mini_container",
+                                        )
+                                    ]
+                                )
+                            ],
+                        )
+                        ,
                     
-                dcc.Loading(dcc.Graph(
-                        id="plot_cum_metrics",
-                        config={ 'displayModeBar': False }
-                    )),
-                dcc.Loading(dcc.Graph(
-                        id="plot_new_metrics",
-                        config={ 'displayModeBar': False }
-                    ))
+                    dcc.Loading(dcc.Graph(
+                            id="plot_cum_metrics",
+                            config={ 'displayModeBar': False }
+                        )),
+                    dcc.Loading(dcc.Graph(
+                            id="plot_new_metrics",
+                            config={ 'displayModeBar': False }
+                        )),
+                    html.Div(className="row", 
+                            style={'margin-left': '2rem'},
+                            children=[
+                        html.Div(className="three columns", children=[
+                            html.H5('Rank Countries By', 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
+                                                }),
+                            dcc.Dropdown(
+                                id='ranking-metric',
+                                options=[{'label':label, 'value':m} for m, label in RANKING_METRICS.items()],
+                                value='NewConfirmed',
+                                clearable=False
+                            ),
+                            dcc.Dropdown(
+                                id='ranking-size',
+                                options=[{'label':'Top %d' % n, 'value':n} for n in RANKING_SIZES],
+                                value=RANKING_SIZES[0],
+                                clearable=False
+                            )
+                        ]),
+                        html.Div(className="nine columns", children=[
+                            html.Table(id='ranking_table', 
+                                        style={
+                                                'width': '100%',
+                                                'color': colors['text']
+                                                })
+                        ])
+                    ]),
+                    html.Div(className="row", 
+                            style={'margin-left': '2rem'},
+                            children=[
+                        html.Div(className="three columns", children=[
+                            html.H5('Compare Countries', 
+                                        style={
+                                                'textAlign': 'left',
+                                                'color': colors['text']
+                                                }),
+                            dcc.Dropdown(
+                                id='compare-countries',
+                                options=dataset.countryOptions,
+                                value=dataset.ranking.nlargest(5, 'CumConfirmed').index.tolist(),
+                                multi=True
+                            ),
+                            dcc.Dropdown(
+                                id='compare-metric',
+                                options=[{'label':label, 'value':m} for m, label in COMPARE_METRICS.items()],
+                                value='CumConfirmed',
+                                clearable=False
+                            )
+                        ]),
+                        html.Div(className="nine columns", children=[
+                            dcc.Loading(dcc.Graph(
+                                    id="plot_compare",
+                                    config={ 'displayModeBar': False }
+                                ))
+                        ])
+                    ])
                         
-                # html.Div([
-                #     html.Div([
-                #         #html.H3('New Metrics'),
-                #         dcc.Graph(
-                #     id="plot_cum_metrics",
-                #     config={ 'displayModeBar': False }
-                # )
-                #     ], className="six columns"),
-
-                #     html.Div([
-                #         #html.H3('Cum Metrics'),
-                #         dcc.Graph(
-                #     id="plot_new_metrics",
-                #     config={ 'displayModeBar': False }
-                # )
-                #     ], className="six columns"),
-                # ], className="row")
-                ,
-                html.Div(className="row", children=[
-                    dcc.Markdown(className='three columns', 
-                                children=['''
-                                > Data by Johns Hopkins University Center for Systems Science and Engineering (JHU CSSE)
-
-                                > [Github](https://github.com/CSSEGISandData/COVID-19)
-                                '''],
-                                style={ 'width': '100%',
-                                        'textAlign': 'left',
-                                        'background-color': colors['background'],
-                                        'color': colors['text'],
-                                        'font-size': 13
-                                        }
-                                    )
-                    ]
-                ),
-            html.Div(id='intermediate', style={'display': 'none'}),
-            dcc.Interval(id='interval-component', interval=1*1000) # in milliseconds
-            ]
-        )
+                    # html.Div([
+                    #     html.Div([
+                    #         #html.H3('New Metrics'),
+                    #         dcc.Graph(
+                    #     id="plot_cum_metrics",
+                    #     config={ 'displayModeBar': False }
+                    # )
+                    #     ], className="six columns"),
 
-def fix_data_errors(data):
-    # fix erros where cum value of today less than yesterday
-    df_fix_err = data.select_dtypes(include='int64').diff() < 0
-    for col in df_fix_err.columns:
-        error_ixs = df_fix_err.index[df_fix_err[col] == True]
-        data.loc[error_ixs, col] = np.nan
-        data[col] = data[col].fillna(method='ffill').astype(np.int64)
+                    #     html.Div([
+                    #         #html.H3('Cum Metrics'),
+                    #         dcc.Graph(
+                    #     id="plot_new_metrics",
+                    #     config={ 'displayModeBar': False }
+                    # )
+                    #     ], className="six columns"),
+                    # ], className="row")
+                    ,
+                    html.Div(className="row", children=[
+                        dcc.Markdown(className='three columns', 
+                                    children=['''
+                                    > Data by Johns Hopkins University Center for Systems Science and Engineering (JHU CSSE)
 
-    return data
+                                    > [Github](https://github.com/CSSEGISandData/COVID-19)
+                                    '''],
+                                    style={ 'width': '100%',
+                                            'textAlign': 'left',
+                                            'background-color': colors['background'],
+                                            'color': colors['text'],
+                                            'font-size': 13
+                                            }
+                                        )
+                        ]
+                    ),
+                html.Div(id='intermediate', style={'display': 'none'}),
+                html.Div(id='data-version', children=str(dataset.version), style={'display': 'none'}),
+                dcc.Interval(id='interval-component', interval=VERSION_POLL_INTERVAL*1000) # in milliseconds
+                ]
+            )
+
+def serve_layout():
+    # called on every page load, so countries added by a reload show up without restarting workers
+    return sync_dataset().layout
+
+@app.callback(
+    Output('data-version', 'children'),
+    [Input('interval-component', 'n_intervals')],
+    [State('data-version', 'children')])
+def check_data_version(n_intervals, shownVersion):
+    # the only request an idle page makes, everything else reruns only when the version moved
+    start = time.perf_counter()
+    version = str(sync_dataset().version)
+    record_latency('check_data_version', start)
+    if version == shownVersion:
+        raise PreventUpdate
+    return version
 
 @app.callback(
     Output('intermediate', 'children'),
-    [Input('country', 'value'), Input('state', 'value')])
-def nonreactive_data(country, state):
-    data = allData.loc[allData['Country/Region'] == country].copy()
+    [Input('country', 'value'), Input('state', 'value'), Input('window', 'value'), Input('data-version', 'children')])
+def nonreactive_data(country, state, window=DEFAULT_WINDOW, shownVersion=None):
+    start = time.perf_counter()
+    current = sync_dataset()
+    key = result_key(current.version, country, state, window)
+    if resultStore.get(key) is None:
+        data = derived_data(current, country, state, window)
+        with metrics.timer('callback_stage_seconds', callback='nonreactive_data', stage='serialize'):
+            resultStore.put(key, data)
+    record_latency('nonreactive_data', start)
+    return key
 
-    data = data.iloc[-14:, :]
-    
-    data = fix_data_errors(data)
+# the table of a (country, state, window) with what the page shows next to it: the resolution
+# of its points, the forecast after its last day and the latest day when the points are periods
+Derived = namedtuple('Derived', ['frame', 'resolution', 'forecast', 'today'])
 
-    data['CumActive'] = data['CumConfirmed'] - data['CumDeaths'] - data['CumRecovered']
+def derived_data(current, country, state, window=DEFAULT_WINDOW):
+    # cached in the dataset it is derived from
+    return current.cache.get((country, state, window), lambda: build_derived(current, country, state, window))
 
-    if state == '<all>':
-        data = data.drop('Province/State', axis=1).groupby("date").sum().reset_index()
+def build_derived(dataset, country, state, window=DEFAULT_WINDOW):
+    with metrics.timer('callback_stage_seconds', callback='nonreactive_data', stage='filter'):
+        # the finest resolution that keeps the chart under MAX_POINTS points
+        days = window or len(view_rows(dataset.views['D'], country, state))
+        resolution = next((resolution for resolution, perPoint in RESOLUTIONS.items() if days / perPoint <= MAX_POINTS), 'M')
+        data = view_rows(dataset.views[resolution], country, state)
+
+    with metrics.timer('callback_stage_seconds', callback='nonreactive_data', stage='derive'):
+        # country rollups come with their metrics, a single state gets them here
+        if state != '<all>':
+            data = derive_metrics(data, np.arange(len(data)) == 0)
+
+        # the window is taken by date once the differences are known, so its first day has them too
+        if window and len(data):
+            dates = data['date'].to_numpy()
+            data = data.iloc[dates.searchsorted(dates[-1] - np.timedelta64(window - 1, 'D')):]
+        # the shared rollup rows are copied before the label column is added
+        data = data.reset_index(drop=True)
+
+        #data['dateStr'] = data['date'].dt.strftime('%b %d, %Y')
+        data['dateStr'] = data.date.dt.strftime('%d %b %y')
+        data = data.loc[~(data[['CumConfirmed', 'CumDeaths', 'CumRecovered', 'NewConfirmed', 'NewDeaths']]==0).all(axis=1)]
+
+    forecast, today = dataset.forecasts.get((country, state)), None
+    if forecast is not None and len(data):
+        # precomputed at refresh, the days after the last one of the series
+        lastDay = view_rows(dataset.views['D'], country, state)['date'].iat[-1]
+        forecast = dict({'date': pd.date_range(lastDay, periods=FORECAST_DAYS + 1)[1:]},
+                        **{col: forecast[:, i] for i, col in enumerate(cols_int)},
+                        CumActive=forecast[:, 0] - forecast[:, 1] - forecast[:, 2])
     else:
-        data = data.loc[data['Province/State'] == state]
-    newCases = data.select_dtypes(include='int64').diff().fillna(0)
-
-    newCases.columns = [column.replace('Cum', 'New') for column in newCases.columns]
-    data = data.join(newCases)
-    #data['dateStr'] = data['date'].dt.strftime('%b %d, %Y')
-    data['dateStr'] = data.date.dt.strftime('%d %b %y')
-    data['DiffYesterday'] = ((data.NewConfirmed.shift(periods=-1) / data.CumConfirmed)*100).round(1)
-    data['MortalityRateInfection'] = ((data.CumDeaths / data.CumConfirmed)*100).round(1)
-    data['MortalityRateClosed'] = ((data.CumDeaths / (data.CumDeaths + data.CumRecovered))*100).round(1)
-    data = data.loc[~(data[['CumConfirmed', 'CumDeaths', 'CumRecovered', 'NewConfirmed', 'NewDeaths']]==0).all(axis=1)]
-    return data.to_json()
+        forecast = None
+    if resolution != 'D':
+        # the tiles show the latest day, the cumulative counts of the last period already are
+        # read from the daily view, the last three days are enough for the differences of a state
+        daily = view_rows(dataset.views['D'], country, state).iloc[-3:]
+        if state != '<all>':
+            daily = derive_metrics(daily, np.arange(len(daily)) == 0)
+        if len(daily) > 1:
+            today = {'NewConfirmed': daily['NewConfirmed'].iat[-1], 'DiffYesterday': daily['DiffYesterday'].iat[-2]}
+    return Derived(data, resolution, forecast, today)
+
+def view_rows(view, country, state):
+    if state == '<all>':
+        return view.rollup.iloc[view.rollupSlices.get(country, slice(0, 0))]
+    return view.states.iloc[view.stateSlices.get((country, state), slice(0, 0))]
 
 @app.callback(
     [Output('state', 'options'), Output('state', 'value')],
     [Input('country', 'value')]
 )
 def update_states(country):
-    states = list(allData.loc[allData['Country/Region'] == country]['Province/State'].unique())
-    states.insert(0, '<all>')
-    states.sort()
-    state_options = [{'label':s, 'value':s} for s in states]
+    start = time.perf_counter()
+    state_options = sync_dataset().stateOptions.get(country, defaultStateOptions)
     state_value = state_options[0]['value']
+    record_latency('update_states', start)
     return state_options, state_value
 
+defaultStateOptions = [{'label':'<all>', 'value':'<all>'}]
+
+metricColors = { 'Deaths':'rgb(200,30,30)', 
+                 'Recovered':'rgb(30,200,30)', 
+                 'Confirmed': colors['text'], 
+                 'Active': 'rgb(245,140,10)'}
+
 def barchart(data, metrics, prefix="", yaxisTitle=""):
     figure = go.Figure(
                         data=[
                                 go.Bar( 
                                     name=metric, x=data.date, y=data[prefix + metric],
                                     marker_line_color='rgb(0,0,0)', marker_line_width=1,
-                                    marker_color={ 'Deaths':'rgb(200,30,30)', 
-                                                   'Recovered':'rgb(30,200,30)', 
-                                                   'Confirmed': colors['text'], 
-                                                   'Active': 'rgb(245,140,10)'}[metric]
+                                    marker_color=metricColors[metric]
                                 ) for metric in metrics
                             ],
                         layout= {
@@ -424,10 +1503,7 @@ def scatterchart(data, metrics, prefix="", yaxisTitle=""):
                                 name=metric, x=data.date, y=data[prefix + metric],
                                 mode='lines+markers',
                                 marker_line_color='rgb(0,0,0)', marker_size=12,
-                                marker_color={ 'Deaths':'rgb(200,30,30)', 
-                                               'Recovered':'rgb(30,200,30)', 
-                                               'Confirmed': colors['text'], 
-                                               'Active': 'rgb(245,140,10)'}[metric]
+                                marker_color=metricColors[metric]
                             ) for metric in metrics
                         ],
                         layout= {
@@ -451,22 +1527,91 @@ def scatterchart(data, metrics, prefix="", yaxisTitle=""):
     return figure
 
 
+def chart_dict(data, metrics, prefix="", yaxisTitle="", kind='bar'):
+    # the same figure barchart/scatterchart build, as a plain dict without plotly's validation
+    x = data['date'].to_numpy()
+    traces = []
+    for metric in metrics:
+        trace = {'type': kind, 'name': metric, 'x': x, 'y': data[prefix + metric].to_numpy()}
+        if kind == 'bar':
+            trace['marker'] = {'line': {'color': 'rgb(0,0,0)', 'width': 1}, 'color': metricColors[metric]}
+        else:
+            trace['mode'] = 'lines+markers'
+            trace['marker'] = {'line': {'color': 'rgb(0,0,0)'}, 'size': 12, 'color': metricColors[metric]}
+        traces.append(trace)
+
+    layout = {
+        'template': figureTemplate,
+        'plot_bgcolor': colors['background'],
+        'paper_bgcolor': colors['background'],
+        'font': tickFont,
+        'legend': dict(x=.05, y=0.95, font={'size':15}, bgcolor='rgba(240,240,240,0.2)'),
+        'xaxis': dict(showticklabels=True, fixedrange=True, title={'text': ""}, tickangle=-45, type='category',
+                      showgrid=False, gridcolor='#DDDDDD', tickfont=tickFont,
+                      ticktext=data['dateStr'].to_numpy(), tickvals=x),
+        'yaxis': dict(showticklabels=True, fixedrange=True, title={'text': yaxisTitle}, showgrid=True,
+                      gridcolor='#DDDDDD'),
+    }
+    if kind == 'bar':
+        layout['barmode'] = 'group'
+    return {'data': traces, 'layout': layout}
+
+figureTemplate = pio.templates[pio.templates.default].to_plotly_json()
+
+def cached_chart(key, derived, metrics_, prefix, yaxisTitle, kind, callback, forecast=False):
+    data = derived.frame
+
+    def build():
+        with metrics.timer('callback_stage_seconds', callback=callback, stage='figure_build'):
+            if RAW_FIGURES:
+                figure = chart_dict(data, metrics_, prefix, yaxisTitle, kind)
+            else:
+                chart = barchart if kind == 'bar' else scatterchart
+                figure = chart(data, metrics_, prefix, yaxisTitle).to_plotly_json()
+            if forecast and derived.forecast is not None:
+                add_forecast(figure, derived, metrics_, prefix)
+            return figure
+
+    return figureCache.figure('%s-%s-%s-%s' % (key, kind, '|'.join(metrics_), forecast), build)
+
+def add_forecast(figure, derived, metrics, prefix):
+    # dashed continuation of every metric from its last point, with the forecast days on the axis
+    data, forecast = derived.frame, derived.forecast
+    dates = forecast['date']
+    for metric in metrics:
+        figure['data'].append({'type': 'scatter', 'mode': 'lines', 'name': metric + ' forecast',
+                               'x': np.append(data['date'].to_numpy()[-1:], dates.values),
+                               'y': np.append(data[prefix + metric].to_numpy()[-1:], forecast[prefix + metric]),
+                               'line': {'dash': 'dash', 'color': metricColors[metric]}})
+    xaxis = figure['layout']['xaxis']
+    xaxis['tickvals'] = np.append(np.asarray(xaxis['tickvals']), dates.values)
+    xaxis['ticktext'] = np.append(np.asarray(xaxis['ticktext']), dates.strftime('%d %b %y'))
+
+
 @app.callback(
     Output('plot_new_metrics', 'figure'), 
     [Input('intermediate', 'children'), Input('metrics', 'value')]
 )
 def update_plot_new_metrics(cleaned_data, metrics):
-    data = pd.read_json(cleaned_data)
+    start = time.perf_counter()
+    data = load_result(cleaned_data)
     metrics_ = [metric for metric in metrics if metric != 'Active']
-    return barchart(data, metrics_, prefix="New", yaxisTitle="New Cases per Day")
+    figure = cached_chart(cleaned_data, data, metrics_, prefix="New", yaxisTitle="New Cases per " + PERIOD_NAMES[data.resolution], kind='bar',
+                          callback='update_plot_new_metrics')
+    record_latency('update_plot_new_metrics', start)
+    return figure
 
 @app.callback(
     Output('plot_cum_metrics', 'figure'), 
-    [Input('intermediate', 'children'), Input('metrics', 'value')]
+    [Input('intermediate', 'children'), Input('metrics', 'value'), Input('forecast', 'value')]
 )
-def update_plot_cum_metrics(cleaned_data, metrics):
-    data = pd.read_json(cleaned_data)
-    return scatterchart(data, metrics, prefix="Cum", yaxisTitle="Cumulated Cases")
+def update_plot_cum_metrics(cleaned_data, metrics, forecast=()):
+    start = time.perf_counter()
+    data = load_result(cleaned_data)
+    figure = cached_chart(cleaned_data, data, metrics, prefix="Cum", yaxisTitle="Cumulated Cases", kind='scatter',
+                          callback='update_plot_cum_metrics', forecast=bool(forecast))
+    record_latency('update_plot_cum_metrics', start)
+    return figure
 
 @app.callback(
     [
@@ -477,20 +1622,24 @@ def update_plot_cum_metrics(cleaned_data, metrics):
         Output('mortality_rate_infection_text', 'children'),
         Output('mortality_rate_closed_text', 'children'),
         Output('cases_increase_text', 'children'),
+        Output('expected_cases_by_tomorrow_text', 'children'),
     ],
     [Input('intermediate', 'children'), Input('country', 'value')]
 )
 def update_text(cleaned_data, country):
-    data = pd.read_json(cleaned_data)
+    start = time.perf_counter()
+    derived = load_result(cleaned_data)
+    data, today = derived.frame, derived.today or {}
     try:
-        new_cases = data['NewConfirmed'].iat[-1]
+        new_cases = today.get('NewConfirmed', data['NewConfirmed'].iat[-1])
         if new_cases > 0:
             new_cases = str('+') + str(new_cases)
         else:
             new_cases = str(new_cases)
             
-        stats = data[['CumConfirmed', 'CumDeaths', 'CumRecovered', 'CumActive', 'MortalityRateInfection', 'MortalityRateClosed']].iloc[-1].tolist() + \
-                [new_cases + ' (' + str(data['DiffYesterday'].iat[-2]) + '%)']
+        # column by column, a row of the all numeric frame would turn the counts into floats
+        stats = [data[col].iat[-1].item() for col in ['CumConfirmed', 'CumDeaths', 'CumRecovered', 'CumActive', 'MortalityRateInfection', 'MortalityRateClosed']] + \
+                [new_cases + ' (' + str(today.get('DiffYesterday', data['DiffYesterday'].iat[-2])) + '%)']
 
         # if country == 'Egypt':
         #     stats[0] = max(stats[0], confirmed_eg) 
@@ -499,11 +1648,164 @@ def update_text(cleaned_data, country):
 
         for stat in range(-3, -1):
             stats[stat] = str(stats[stat]) + '%'
+
+        forecast = derived.forecast
+        stats.append(forecast['CumConfirmed'][0].item() if forecast else 'NA')
             
     except:
-        stats = [0, 0, 0, 0, 0, 0, 0]
+        stats = [0, 0, 0, 0, 0, 0, 0, 'NA']
+    record_latency('update_text', start)
     return stats
 
+@app.server.route('/stats')
+def stats():
+    lookups = figureCache.hits + figureCache.misses
+    latency = {}
+    for name, samples in list(latencies.items()):
+        samples = np.array(samples) * 1000
+        latency[name] = {'count': len(samples), 'p50_ms': np.percentile(samples, 50),
+                         'p99_ms': np.percentile(samples, 99)}
+    return flask.jsonify({
+        'version': dataset.version,
+        'staleness_s': staleness(),
+        'figure_cache': {'hits': figureCache.hits, 'misses': figureCache.misses, 'size': len(figureCache.results),
+                         'hit_rate': figureCache.hits / lookups if lookups else None},
+        'latency': latency,
+    })
+
+def format_metric(metric, value):
+    if pd.isna(value):
+        return 'NA'
+    if metric in ('MortalityRateInfection', 'Growth'):
+        return '%.1f%%' % value
+    return '{:,}'.format(int(value))
+
+@app.callback(
+    Output('ranking_table', 'children'),
+    [Input('ranking-metric', 'value'), Input('ranking-size', 'value'), Input('data-version', 'children')])
+def update_ranking(metric, size, shownVersion=None):
+    # every country's latest metrics are computed at refresh, ranking them is a sort of one column
+    start = time.perf_counter()
+    top = sync_dataset().ranking.nlargest(size, metric)
+    columns = [metric] + [col for col in ('CumConfirmed', 'CumDeaths', 'NewConfirmed') if col != metric]
+    header = html.Tr([html.Th('#'), html.Th('Country')] +
+                     [html.Th(RANKING_METRICS.get(col) or COMPARE_METRICS[col]) for col in columns])
+    rows = [html.Tr([html.Td(rank), html.Td(country)] + [html.Td(format_metric(col, row[col])) for col in columns])
+            for rank, (country, row) in enumerate(top.iterrows(), 1)]
+    record_latency('update_ranking', start)
+    return [header] + rows
+
+def compare_chart(series, metric):
+    # one line per country over the selected window, the dates of the countries need not match
+    return {
+        'data': [{'type': 'scatter', 'mode': 'lines', 'name': country, 'x': data['date'].to_numpy(),
+                  'y': data[metric].to_numpy()} for country, data in series],
+        'layout': {
+            'template': figureTemplate,
+            'plot_bgcolor': colors['background'],
+            'paper_bgcolor': colors['background'],
+            'font': tickFont,
+            'legend': dict(x=.05, y=0.95, font={'size':15}, bgcolor='rgba(240,240,240,0.2)'),
+            'xaxis': dict(fixedrange=True, type='date', showgrid=False, tickfont=tickFont),
+            'yaxis': dict(fixedrange=True, title={'text': COMPARE_METRICS[metric]}, showgrid=True, gridcolor='#DDDDDD'),
+        },
+    }
+
+@app.callback(
+    Output('plot_compare', 'figure'),
+    [Input('compare-countries', 'value'), Input('compare-metric', 'value'), Input('window', 'value'),
+     Input('data-version', 'children')])
+def update_plot_compare(countries, metric, window, shownVersion=None):
+    start = time.perf_counter()
+    current = sync_dataset()
+    countries = (countries or [])[:COMPARE_MAX]
+
+    def build():
+        with metrics.timer('callback_stage_seconds', callback='update_plot_compare', stage='figure_build'):
+            # the country rollups are precomputed, each one is a cached slice
+            return compare_chart([(country, derived_data(current, country, '<all>', window).frame) for country in countries],
+                                 metric)
+
+    figure = figureCache.figure(result_key(current.version, 'compare', tuple(countries), metric, window), build)
+    record_latency('update_plot_compare', start)
+    return figure
+
+@metrics.collector
+def collect_dataset():
+    current = dataset
+    return [('gauge', 'dataset_version', {}, current.version),
+            ('gauge', 'dataset_rows', {}, len(current.data)),
+            ('gauge', 'dataset_memory_bytes', {}, int(current.data.memory_usage(deep=True).sum())),
+            ('gauge', 'dataset_high_water_timestamp_seconds', {}, current.highWater.timestamp())]
+
+@metrics.collector
+def collect_caches():
+    derived = dataset.cache
+    return [('counter', 'cache_hits_total', {'cache': 'figure'}, figureCache.hits),
+            ('counter', 'cache_misses_total', {'cache': 'figure'}, figureCache.misses),
+            # per dataset, they restart from zero on every reload
+            ('counter', 'cache_hits_total', {'cache': 'derived'}, derived.hits),
+            ('counter', 'cache_misses_total', {'cache': 'derived'}, derived.misses),
+            ('gauge', 'cache_entries', {'cache': 'figure'}, len(figureCache.results)),
+            ('gauge', 'cache_entries', {'cache': 'derived'}, len(derived.entries)),
+            ('gauge', 'cache_entries', {'cache': 'result'}, len(resultStore.results))]
+
+@metrics.collector
+def collect_refresh():
+    samples = [('gauge', 'refresh_consecutive_failures', {}, refreshState['failures'])]
+    if last_refresh() is not None:
+        samples += [('gauge', 'refresh_last_success_timestamp_seconds', {}, last_refresh()),
+                    ('gauge', 'data_staleness_seconds', {}, staleness())]
+    return samples
+
+@app.server.route('/health')
+def health():
+    # fails once the data was not checked against its source for STALE_AFTER seconds
+    current, age = dataset, staleness()
+    status = 'stale' if age > STALE_AFTER else 'ok' if last_refresh() is not None else 'starting'
+    response = flask.jsonify({
+        'status': status,
+        'version': current.version,
+        'high_water': current.highWater.strftime('%Y-%m-%d'),
+        'staleness_s': age,
+        'consecutive_failures': refreshState['failures'],
+        'last_error': refreshState['lastError'],
+    })
+    response.status_code = 503 if status == 'stale' else 200
+    return response
+
+@app.server.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        flask.abort(404)
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# a cached snapshot is served right away, the refresher thread brings it up to date in the background,
+# loaded down here as every dataset comes with its layout
+dataset = load_snapshot()
+if dataset is None:
+    if is_refresher():
+        while dataset is None:
+            try:
+                dataset = update_dataset(None)
+            except Exception as e:
+                refreshState['failures'] += 1
+                refreshState['lastError'] = repr(e)
+                print('INITIAL LOAD FAILED: %r' % e)
+                time.sleep(backoff(refreshState['failures']))
+        save_snapshot(dataset)
+        refresh_succeeded()
+    else:
+        while dataset is None:
+            time.sleep(1)
+            dataset = load_snapshot()
+snapshotStamp = snapshot_stamp()
+
+app.layout = serve_layout
+
+thread = threading.Thread(target=refresh_data_every, daemon=True)
+thread.start()
+
 if __name__ == '__main__':
     app.run_server(port=8080, debug=True, threaded=True, processes=1)
     
\ No newline at end of file
@@ -0,0 +1,652 @@
+import argparse
+import functools
+import hashlib
+import http.server
+import inspect
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# app is imported in __main__, once the environment selected its data source
+app = None
+
+
+def timeit(func, repeat=50):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def grow(data, factor):
+    # replicate the dataset under renamed countries to simulate a bigger allData
+    copies = []
+    for i in range(factor):
+        copy = data.copy()
+        if i:
+            copy['Country/Region'] = copy['Country/Region'].astype(str) + ' #' + str(i)
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def percentiles(samples):
+    samples = np.array(samples) * 1000
+    return '%6d calls  p50 %8.3f ms  p90 %8.3f ms  p99 %8.3f ms' % (
+        len(samples), np.percentile(samples, 50), np.percentile(samples, 90), np.percentile(samples, 99))
+
+
+def memory():
+    memory = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if key in ('Rss', 'Pss'):
+                memory[key] = int(value.split()[0]) // 1024
+    return memory
+
+
+def load(data):
+    app.publish(app.make_dataset(app.sort_data(data).reset_index(drop=True), app.dataset.version + 1, {}))
+
+
+def bench_index(base, factors=(1, 4, 16, 64), country='Egypt'):
+    print('%8s %10s %12s %12s %12s' % ('factor', 'rows', 'mask (ms)', 'index (ms)', 'callback (ms)'))
+    for factor in factors:
+        data = grow(base, factor)
+        load(data)
+
+        mask = timeit(lambda: data.loc[data['Country/Region'] == country])
+        index = timeit(lambda: app.dataset.data.iloc[app.dataset.countrySlices[country]])
+        callback = timeit(lambda: (app.build_derived(app.dataset, country, '<all>'),
+                                   app.update_states(country)))
+        print('%8d %10d %12.3f %12.3f %12.3f' % (factor, len(data), mask, index, callback))
+
+
+def bench_windows(base, factor=16, repeat=20, metrics=('Confirmed', 'Deaths', 'Active')):
+    # the derived table of the country with the most states for every date window, the '<all>' series
+    # comes from the rollup so it costs the same as a single state, and long windows move to coarser
+    # resolutions so the chart payload stays bounded
+    load(grow(base, factor))
+    country = max(app.dataset.countryStates, key=lambda country: len(app.dataset.countryStates[country]))
+    state = app.dataset.countryStates[country][-1]
+    print('%s, %d states, %d rows' % (country, len(app.dataset.countryStates[country]) - 1,
+                                      len(app.dataset.data.iloc[app.dataset.countrySlices[country]])))
+    for window, label in app.DATE_WINDOWS.items():
+        rollup = timeit(lambda: app.build_derived(app.dataset, country, '<all>', window), repeat)
+        single = timeit(lambda: app.build_derived(app.dataset, country, state, window), repeat)
+        key = app.nonreactive_data(country, '<all>', window)
+        data = app.load_result(key)
+        payload = len(pio.to_json(app.update_plot_cum_metrics(key, list(metrics)), validate=False))
+        print('%-14s <all>: %8.3f ms, one state: %8.3f ms, %4d points (%s), payload %7d bytes' %
+              (label, rollup, single, len(data.frame), data.resolution, payload))
+
+
+def bench_engine(base, factor=4, repeat=3):
+    # the metrics of every country in one vectorized pass against one derived_data call per country
+    load(grow(base, factor))
+    dataset = app.dataset
+    perCountry = timeit(lambda: [app.build_derived(dataset, country, '<all>', 0)
+                                 for country in dataset.countries], repeat)
+    engine = timeit(lambda: app.build_ranking(app.build_views(dataset.data, dataset.stateSlices)['D']), repeat)
+    ranking = timeit(lambda: app.update_ranking('NewConfirmed', 20), repeat * 10)
+    print('%d countries, per country: %.1f ms, vectorized views + ranking: %.1f ms, ranking callback: %.3f ms' %
+          (len(dataset.countries), perCountry, engine, ranking))
+
+
+def bench_derived(base, countries=20, repeat=20):
+    load(base)
+    hot = list(app.dataset.countries[:countries])
+
+    def cold():
+        # a fresh dataset starts with an empty cache
+        current = app.dataset._replace(cache=app.SnapshotCache())
+        for country in hot:
+            app.derived_data(current, country, '<all>')
+
+    def warm():
+        for country in hot:
+            app.derived_data(app.dataset, country, '<all>')
+
+    print('%d countries, cold: %.3f ms/callback, cached: %.3f ms/callback' %
+          (len(hot), timeit(cold, repeat) / len(hot), timeit(warm, repeat) / len(hot)))
+    print('hits %d, misses %d' % (app.dataset.cache.hits, app.dataset.cache.misses))
+
+
+def fix_data_errors_loop(data):
+    # the previous per-column implementation, kept as the reference for bench_fix
+    df_fix_err = data.select_dtypes(include='int64').diff() < 0
+    for col in df_fix_err.columns:
+        error_ixs = df_fix_err.index[df_fix_err[col] == True]
+        data.loc[error_ixs, col] = np.nan
+        data[col] = data[col].ffill().astype(np.int64)
+    return data
+
+
+def bench_fix(base, factor=16, repeat=5):
+    data = grow(base, factor).astype({col: np.int64 for col in app.cols_int})
+    data = app.sort_data(data).reset_index(drop=True)
+    groups = [rows for _, rows in data.groupby(['Country/Region', 'Province/State'], observed=True)]
+
+    for rows in groups[:50]:
+        expected = fix_data_errors_loop(rows.copy())[app.cols_int].to_numpy()
+        assert (app.fix_data_errors(rows.copy())[app.cols_int].to_numpy() == expected).all()
+
+    loop = timeit(lambda: [fix_data_errors_loop(rows.copy()) for rows in groups], repeat)
+    vectorized = timeit(lambda: app.fix_data_errors(data.copy()), repeat)
+    print('%d rows in %d series, loop: %.1f ms, vectorized: %.1f ms' % (len(data), len(groups), loop, vectorized))
+
+
+def bench_store(base, country='Egypt', metrics=('Confirmed', 'Deaths', 'Active'), repeat=50):
+    load(base)
+    data = app.derived_data(app.dataset, country, '<all>')
+
+    def json_roundtrip():
+        payload = data.frame.to_json()
+        for _ in range(3):
+            pd.read_json(io.StringIO(payload))
+        return payload
+
+    def store_roundtrip():
+        key = app.nonreactive_data(country, '<all>')
+        for _ in range(3):
+            app.load_result(key)
+        return key
+
+    print('json:  payload %6d bytes, %.3f ms' % (len(json_roundtrip()), timeit(json_roundtrip, repeat)))
+    print('store: payload %6d bytes, %.3f ms' % (len(store_roundtrip()), timeit(store_roundtrip, repeat)))
+
+    key = app.nonreactive_data(country, '<all>')
+    callbacks = lambda: (app.update_plot_new_metrics(key, list(metrics)),
+                         app.update_plot_cum_metrics(key, list(metrics)),
+                         app.update_text(key, country))
+    print('consumer callbacks: %.3f ms' % timeit(callbacks, repeat))
+
+    # tokens come from the browser: files are named by digest and malformed tokens are refused
+    resultStore, app.resultStore = app.resultStore, app.FileResultStore(tempfile.mkdtemp())
+    app.resultStore.put(key, data)
+    assert all(name.endswith('.pkl') and '|' not in name for name in os.listdir(app.resultStore.directory))
+    assert app.FileResultStore(app.resultStore.directory).get(key).frame.equals(data.frame)
+    for token in ('../../rv/outside', '1|../x|%22%3Call%3E%22|14', '1|%22Egypt%22|%22%3Call%3E%22', '1|a|b|c', 'x|y'):
+        try:
+            app.update_text(token, country)
+        except app.PreventUpdate:
+            continue
+        raise AssertionError(token)
+    shutil.rmtree(app.resultStore.directory)
+    app.resultStore = resultStore
+
+
+MEMORY = inspect.getsource(memory)
+
+WORKER = MEMORY + """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print('ready', flush=True)
+sys.stdin.readline()
+print(json.dumps(dict(memory(), startup=elapsed)), flush=True)
+"""
+
+FOLLOWER = MEMORY + """
+import json, os, sys, time
+import app
+print('ready', flush=True)
+for _ in range(int(sys.argv[1])):
+    # what every request does in multi worker mode
+    version = app.sync_dataset().version
+    print(json.dumps(dict(memory(), version=version, refresher=app.refreshLock is not None)), flush=True)
+    time.sleep(0.5)
+# hold the refresh lock until every worker reported, so it is never handed over
+print('done', flush=True)
+sys.stdin.readline()
+"""
+
+
+def write_ulklc(data, path):
+    # the dataset in the layout of the ulklc rawReport.csv, which has no states
+    data = data.groupby(['Country/Region', 'date'], observed=True, as_index=False) \
+               .agg(dict({'Province/State': 'first', 'Lat': 'first', 'Long': 'first'},
+                         **{col: 'sum' for col in app.cols_int}))
+    data = data.rename(columns={'Country/Region': 'countryName', 'Lat': 'lat', 'Long': 'long',
+                                'CumConfirmed': 'confirmed', 'CumDeaths': 'death',
+                                'CumRecovered': 'recovered', 'date': 'day'})
+    data = data.rename(columns={'long': 'lon'}).drop('Province/State', axis=1)
+    data['region'] = ''
+    data['countryCode'] = ''
+    # replace the file in one go, a refresher must never read it half written
+    data.to_csv(path + '.tmp', index=False, date_format='%Y/%m/%d')
+    os.replace(path + '.tmp', path)
+
+
+def start_worker(script, env, *args):
+    return subprocess.Popen([sys.executable, '-c', script] + list(args), env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+
+def spawn_workers(envs):
+    # start the workers together and measure them once all are up, so Pss shows the shared pages
+    workers = [start_worker(WORKER, env) for env in envs]
+    for worker in workers:
+        read_line(worker, 'ready')
+    results = []
+    for worker in workers:
+        worker.stdin.write('\n')
+        worker.stdin.flush()
+        line = read_line(worker, '{')
+        results.append(json.JSONDecoder().raw_decode(line[line.index('{'):])[0])
+        worker.kill()
+    return results
+
+
+def read_line(worker, marker):
+    # the refresher thread of a worker prints too, skip its lines
+    for line in worker.stdout:
+        if marker in line:
+            return line
+    raise RuntimeError('worker exited with %s' % worker.wait())
+
+
+def bench_coldstart(base, workers=4):
+    # the download is replaced by reading the dataset as local JHU files
+    snapshotDir, sourceDir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    write_jhu(base, sourceDir)
+    env = dict(os.environ, SNAPSHOT_DIR=snapshotDir, DATA_SOURCE='jhu', JHU_URL=sourceDir + '/')
+    print('%-10s %12s %10s %10s' % ('start', 'import (s)', 'RSS (MB)', 'PSS (MB)'))
+    for label in ('download', 'snapshot'):
+        if label == 'download':
+            # every worker downloads on its own when there is no snapshot yet
+            results = spawn_workers([dict(env, SNAPSHOT_DIR=tempfile.mkdtemp()) for _ in range(workers)])
+        else:
+            spawn_workers([env])
+            results = spawn_workers([env] * workers)
+        for result in results:
+            print('%-10s %12.3f %10d %10d' % (label, result['startup'], result['Rss'], result['Pss']))
+    shutil.rmtree(snapshotDir)
+    shutil.rmtree(sourceDir)
+
+
+def bench_workers(base, workers=4, ticks=20, maxGrowth=0.5):
+    # multi worker mode: one refresher, the others follow its snapshot, all end on the same version
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'rawReport.csv')
+    lastDay = base['date'].max()
+    write_ulklc(base.loc[base['date'] < lastDay], source)
+    env = dict(os.environ, MULTI_WORKER='1', RELOAD_INTERVAL='1', DATA_SOURCE='ulklc', ULKLC_URL=source,
+               SNAPSHOT_DIR=os.path.join(directory, 'snapshot'))
+
+    processes = [start_worker(FOLLOWER, env, str(ticks)) for _ in range(workers)]
+    for worker in processes:
+        read_line(worker, 'ready')
+    # publish one more day while the workers are running
+    time.sleep(1)
+    write_ulklc(base, source)
+
+    print('%8s %10s %10s %10s %10s' % ('worker', 'refresher', 'versions', 'max RSS', 'max PSS'))
+    final = set()
+    refreshers = 0
+    growth = []
+    for i, worker in enumerate(processes):
+        reports = []
+        for line in iter(worker.stdout.readline, ''):
+            if 'done' in line:
+                break
+            if '{' in line:
+                reports.append(json.JSONDecoder().raw_decode(line[line.index('{'):])[0])
+        versions = sorted(set(report['version'] for report in reports))
+        refreshers += any(report['refresher'] for report in reports)
+        final.add(reports[-1]['version'])
+        growth.append(max(report['Rss'] for report in reports) / reports[0]['Rss'] - 1)
+        print('%8d %10s %10s %10d %10d' % (i, any(report['refresher'] for report in reports),
+                                          ','.join(map(str, versions)),
+                                          max(report['Rss'] for report in reports),
+                                          max(report['Pss'] for report in reports)))
+    print('refreshers: %d, final versions: %s, max RSS growth %d%%' % (refreshers, sorted(final), max(growth) * 100))
+    for worker in processes:
+        worker.communicate('\n')
+    shutil.rmtree(directory)
+    # the appended day is one new version that every worker follows, and following it
+    # costs a worker one more dataset, not one per tick
+    assert refreshers == 1, refreshers
+    assert final == {2}, final
+    assert max(growth) <= maxGrowth, growth
+
+
+def bench_memory(base):
+    # the layout the loaders used to produce: python strings, float64 coordinates, int64 counts
+    wide = base.astype({'Country/Region': object, 'Province/State': object, 'Lat': np.float64, 'Long': np.float64})
+    wide = wide.astype({col: np.int64 for col in app.cols_int})
+    compact = app.compact_dtypes(wide.copy())
+    for label, data in (('object/int64', wide), ('compact', compact)):
+        usage = data.memory_usage(deep=True)
+        print('%-14s %8.1f MB  %s' % (label, usage.sum() / 2 ** 20,
+                                     ', '.join('%s=%s' % (col, data[col].dtype) for col in data.columns)))
+
+
+def write_jhu(data, directory):
+    # the dataset as the three wide JHU files, recovered misses a few series like the real one does
+    data = data.astype({'Country/Region': object, 'Province/State': object})
+    # written as an empty cell like in the JHU files
+    data['Province/State'] = data['Province/State'].mask(data['Province/State'] == '<all>', '')
+    data['day'] = data['date'].dt.strftime('%m/%d/%y')
+    for col, fileName in app.JHU_FILES.items():
+        wide = data.pivot(index=['Province/State', 'Country/Region', 'Lat', 'Long'], columns='day', values=col) \
+                   .reset_index()
+        wide = wide[list(wide.columns[:4]) + sorted(wide.columns[4:], key=lambda day: pd.to_datetime(day))]
+        if col == 'CumRecovered':
+            wide = wide.iloc[5:]
+        wide.to_csv(os.path.join(directory, fileName), index=False)
+
+
+def bench_jhu(base, repeat=3):
+    directory = tempfile.mkdtemp()
+    write_jhu(base, directory)
+    source = app.JhuSource(directory + '/')
+    # the legacy loader reads from the module's base URL
+    baseURLJH, app.baseURLJH = app.baseURLJH, source.baseURL
+
+    def merged():
+        frames = [app.loadDataJH(fileName, col) for col, fileName in app.JHU_FILES.items()]
+        return frames[0].merge(frames[1]).merge(frames[2])
+
+    def aligned():
+        return source.fetch({})[0]
+
+    # the merge is an inner join, the aligned loader keeps series missing from a file with zeros
+    expected = app.clean_data(merged())
+    actual = app.clean_data(aligned())
+    series = ['Country/Region', 'Province/State']
+    kept = pd.MultiIndex.from_frame(actual[series].astype(str)).isin(
+        pd.MultiIndex.from_frame(expected[series].astype(str)))
+    actual = actual.loc[kept].reset_index(drop=True)
+    for col in ['date'] + app.cols_int:
+        assert (expected[col].to_numpy() == actual[col].to_numpy()).all(), col
+
+    for label, loader in (('melt + merge', merged), ('concurrent', aligned)):
+        elapsed = timeit(loader, repeat)
+        tracemalloc.start()
+        loader()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-14s %10.1f ms %10.1f MB peak' % (label, elapsed, peak / 2 ** 20))
+    app.baseURLJH = baseURLJH
+    shutil.rmtree(directory)
+
+
+class ETagHandler(http.server.SimpleHTTPRequestHandler):
+    # serves files with a content ETag and answers If-None-Match with 304, like the data sources do
+    statuses = []
+
+    def do_GET(self):
+        with open(self.translate_path(self.path), 'rb') as f:
+            content = f.read()
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        status = 304 if self.headers.get('If-None-Match') == etag else 200
+        self.statuses.append(status)
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content) if status == 200 else 0))
+        self.end_headers()
+        if status == 200:
+            self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_refresh(base, country='Egypt', revisedDay=10):
+    # refreshes through an HTTP stand-in: an unchanged file, a revised past day, an appended day
+    # and a file with the same rows
+    directory = tempfile.mkdtemp()
+    path = directory + '/rawReport.csv'
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(ETagHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    dataSource, app.dataSource = app.dataSource, app.UlklcSource('http://127.0.0.1:%d/rawReport.csv' % server.server_port)
+    lastDay = base['date'].max()
+
+    def refresh(current, data):
+        if data is not None:
+            write_ulklc(data, path)
+        start = time.perf_counter()
+        updated = app.update_dataset(current)
+        elapsed = (time.perf_counter() - start) * 1000
+        if updated is not current:
+            expected = app.clean_data(app.loadData_ulklc(path))
+            for col in app.cols_int:
+                assert (updated.data[col].to_numpy() == expected[col].to_numpy()).all(), col
+        return updated, elapsed
+
+    current, elapsed = refresh(None, base.loc[base['date'] < lastDay])
+    print('%-14s %10.1f ms  version %d' % ('initial', elapsed, current.version))
+
+    updated, elapsed = refresh(current, None)
+    assert updated is current and ETagHandler.statuses[-1] == 304
+    print('%-14s %10.1f ms  version %d' % ('not modified', elapsed, updated.version))
+
+    # the same rows with higher counts from some day on, as when a country corrects its history
+    revised = base.loc[base['date'] < lastDay].astype({'CumConfirmed': np.int64})
+    later = (revised['Country/Region'] == country) & (revised['date'] >= revised['date'].min() + pd.Timedelta(days=revisedDay))
+    revised.loc[later, 'CumConfirmed'] += 1000
+    # and a reporting error on its last day, fixed from the raw counts around it
+    previousDay = (revised['Country/Region'] == country) & (revised['date'] == lastDay - pd.Timedelta(days=1))
+    good = revised.loc[previousDay, 'CumConfirmed'].iat[0]
+    revised.loc[previousDay, 'CumConfirmed'] = good - 50
+    updated, elapsed = refresh(current, revised)
+    assert updated.version == current.version + 1 and len(updated.data) == len(current.data)
+    print('%-14s %10.1f ms  version %d' % ('revised', elapsed, updated.version))
+
+    current = updated
+    # the new day lies between the error and the last good count, so it is kept as it is
+    newDay = base.loc[base['date'] == lastDay].astype({'CumConfirmed': np.int64})
+    newDay.loc[newDay['Country/Region'] == country, 'CumConfirmed'] = good - 20
+    revised = pd.concat([revised, newDay])
+    updated, elapsed = refresh(current, revised)
+    assert updated.version == current.version + 1 and len(updated.data) > len(current.data)
+    print('%-14s %10.1f ms  version %d' % ('appended', elapsed, updated.version))
+
+    # the same rows in a file with another ETag is no new version
+    current = updated
+    with open(path, 'a') as f:
+        f.write('\n')
+    updated, elapsed = refresh(current, None)
+    assert updated.version == current.version and ETagHandler.statuses[-1] == 200
+    print('%-14s %10.1f ms  version %d' % ('rewritten', elapsed, updated.version))
+
+    app.dataSource = dataSource
+    server.shutdown()
+    shutil.rmtree(directory)
+
+
+def bench_figures(base, country='Egypt', metrics=('Confirmed', 'Deaths', 'Active'), repeat=50):
+    load(base)
+    key = app.nonreactive_data(country, '<all>')
+    data = app.load_result(key).frame
+    metrics = list(metrics)
+
+    validated = timeit(lambda: app.scatterchart(data, metrics, 'Cum', 'Cumulated Cases').to_plotly_json(), repeat)
+    raw = timeit(lambda: app.chart_dict(data, metrics, 'Cum', 'Cumulated Cases', 'scatter'), repeat)
+    cached = timeit(lambda: app.update_plot_cum_metrics(key, metrics), repeat)
+    print('go.Figure: %.3f ms, raw dict: %.3f ms, cached callback: %.3f ms' % (validated, raw, cached))
+    print(app.app.server.test_client().get('/stats').get_json())
+
+
+def bench_callbacks(base, rounds=200, seed=0):
+    # every callback called directly the way one page view triggers them, with random selections
+    load(base)
+    rng = np.random.default_rng(seed)
+    countries = list(app.dataset.countries)
+    metricSets = [['Confirmed', 'Deaths', 'Active'], ['Confirmed', 'Recovered'], ['Deaths']]
+    windows = list(app.DATE_WINDOWS)
+    rankingMetrics = list(app.RANKING_METRICS)
+    timings = {}
+
+    def timed(callback, *args):
+        start = time.perf_counter()
+        result = callback(*args)
+        timings.setdefault(callback.__name__, []).append(time.perf_counter() - start)
+        return result
+
+    for _ in range(rounds):
+        country = countries[rng.integers(len(countries))]
+        options, state = timed(app.update_states, country)
+        # None when the state dropdown is cleared
+        states = [option['value'] for option in options] + [None]
+        state = states[rng.integers(len(states))]
+        window = windows[rng.integers(len(windows))]
+        key = timed(app.nonreactive_data, country, state, window, str(app.dataset.version))
+        metrics = metricSets[rng.integers(len(metricSets))]
+        timed(app.update_text, key, country)
+        timed(app.update_plot_new_metrics, key, metrics)
+        timed(app.update_plot_cum_metrics, key, metrics)
+        timed(app.update_ranking, rankingMetrics[rng.integers(len(rankingMetrics))], 10)
+        timed(app.update_plot_compare, list(rng.choice(countries, 3, replace=False)), 'CumConfirmed', window)
+
+    # a series without rows shows empty charts and zero tiles
+    key = app.nonreactive_data(countries[0], 'no such state', 14)
+    assert len(app.load_result(key).frame) == 0 and app.update_text(key, countries[0])[0] == 0
+
+    for name, samples in timings.items():
+        print('%-26s %s' % (name, percentiles(samples)))
+
+
+def dash_update(session, url, outputs, inputs):
+    # one POST to _dash-update-component, outputs are (id, property) and inputs (id, property, value)
+    if len(outputs) == 1:
+        output = '%s.%s' % outputs[0]
+        outputSpec = {'id': outputs[0][0], 'property': outputs[0][1]}
+    else:
+        output = '..' + '...'.join('%s.%s' % spec for spec in outputs) + '..'
+        outputSpec = [{'id': id_, 'property': prop} for id_, prop in outputs]
+    response = session.post(url + '/_dash-update-component', json={
+        'output': output,
+        'outputs': outputSpec,
+        'inputs': [{'id': id_, 'property': prop, 'value': value} for id_, prop, value in inputs],
+        'state': [],
+        'changedPropIds': ['%s.%s' % inputs[0][:2]],
+    })
+    response.raise_for_status()
+    return response.json()['response']
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def bench_http(base, users=8, rounds=25, seed=0):
+    # concurrent simulated users going through the Dash HTTP endpoint of an in-process server
+    load(base)
+    server = make_server('127.0.0.1', 0, app.app.server, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d' % server.server_port
+    countries = list(app.dataset.countries)
+    version = str(app.dataset.version)
+    windows = [int(window) for window in app.DATE_WINDOWS]
+    timings = {}
+    lock = threading.Lock()
+
+    def user(userId):
+        rng = np.random.default_rng(seed + userId)
+        session = requests.Session()
+
+        def timed(name, outputs, inputs):
+            start = time.perf_counter()
+            response = dash_update(session, url, outputs, inputs)
+            with lock:
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+            return response
+
+        for _ in range(rounds):
+            country = countries[rng.integers(len(countries))]
+            response = timed('update_states', [('state', 'options'), ('state', 'value')],
+                             [('country', 'value', country)])
+            options = response['state']['options']
+            state = options[rng.integers(len(options))]['value']
+            window = windows[rng.integers(len(windows))]
+            response = timed('nonreactive_data', [('intermediate', 'children')],
+                             [('country', 'value', country), ('state', 'value', state), ('window', 'value', window),
+                              ('data-version', 'children', version)])
+            key = response['intermediate']['children']
+            metrics = ['Confirmed', 'Deaths', 'Active']
+            timed('update_text', [(output, 'children') for output in (
+                      'confirmed_text', 'deaths_text', 'recovered_text', 'active_text',
+                      'mortality_rate_infection_text', 'mortality_rate_closed_text', 'cases_increase_text',
+                      'expected_cases_by_tomorrow_text')],
+                  [('intermediate', 'children', key), ('country', 'value', country)])
+            timed('update_plot_new_metrics', [('plot_new_metrics', 'figure')],
+                  [('intermediate', 'children', key), ('metrics', 'value', metrics)])
+            timed('update_plot_cum_metrics', [('plot_cum_metrics', 'figure')],
+                  [('intermediate', 'children', key), ('metrics', 'value', metrics),
+                   ('forecast', 'value', ['forecast'] if rng.random() < 0.5 else [])])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(users) as pool:
+        list(pool.map(user, range(users)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    total = sum(len(samples) for samples in timings.values())
+    print('%d users, %d requests in %.2f s: %.1f req/s, memory %s' % (users, total, elapsed, total / elapsed, memory()))
+    for name, samples in timings.items():
+        print('%-26s %s' % (name, percentiles(samples)))
+
+
+if __name__ == '__main__':
+    benches = {
+        'index': bench_index,
+        'derived': bench_derived,
+        'windows': bench_windows,
+        'engine': bench_engine,
+        'fix': bench_fix,
+        'store': bench_store,
+        'coldstart': bench_coldstart,
+        'workers': bench_workers,
+        'memory': bench_memory,
+        'jhu': bench_jhu,
+        'refresh': bench_refresh,
+        'figures': bench_figures,
+        'callbacks': bench_callbacks,
+        'http': bench_http,
+    }
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the data loading and the Dash callbacks.')
+    parser.add_argument('benches', nargs='*', choices=[[]] + list(benches), help='benchmarks to run, all by default')
+    parser.add_argument('--countries', type=int, default=50, help='synthetic countries')
+    parser.add_argument('--states', type=int, default=1, help='synthetic states per country')
+    parser.add_argument('--days', type=int, default=120, help='synthetic days per series')
+    parser.add_argument('--users', type=int, default=8, help='concurrent users of the http benchmark')
+    parser.add_argument('--rounds', type=int, default=25, help='page views per user of the http benchmark')
+    parser.add_argument('--live', action='store_true', help='use the data source configured in the environment')
+    args = parser.parse_args()
+
+    if not args.live:
+        # the app starts on a token generated dataset, nothing is downloaded
+        os.environ.update(DATA_SOURCE='synthetic', SYNTHETIC_SIZE='1,1,2', SNAPSHOT_DIR=tempfile.mkdtemp())
+    import app
+    if not args.live:
+        # the benchmarked data is generated, written as the JHU files and read back by their loaders
+        directory = tempfile.mkdtemp()
+        write_jhu(app.synthetic_data(args.countries, args.states, args.days), directory)
+        app.dataSource = app.JhuSource(directory + '/')
+        app.publish(app.update_dataset(None))
+
+    benches['http'] = functools.partial(bench_http, users=args.users, rounds=args.rounds)
+    base = app.dataset.data.copy()
+    for name in args.benches or benches:
+        print('== %s ==' % name)
+        benches[name](base)